@@ -1,9 +1,18 @@
 from django.contrib.gis import admin
 
+from lizard_history.models import HistoryEntry
 from lizard_history.models import MonitoredModel
 
 
 class MonitoredModelAdmin(admin.ModelAdmin):
         list_display = ('name', 'app_label', 'model')
 
+
+class HistoryEntryAdmin(admin.ModelAdmin):
+        list_display = ('action_time', 'user', 'content_type', 'object_repr',
+                        'action')
+        list_filter = ('action', 'content_type')
+        raw_id_fields = ('user',)
+
 admin.site.register(MonitoredModel, MonitoredModelAdmin)
+admin.site.register(HistoryEntry, HistoryEntryAdmin)
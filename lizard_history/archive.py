@@ -0,0 +1,69 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Archives of history entries as gzip compressed JSON lines.
+
+Every line holds one entry, with its change message decoded but
+otherwise as stored, so extras blob references are kept as references,
+unless they are resolved for an export that should stand on its own.
+"""
+import gzip
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+from django.utils import simplejson
+
+from lizard_history import blobs
+from lizard_history import codec
+from lizard_history.storage import get_storage
+
+
+def entry_record(log_entry, resolve_blobs=False):
+    """
+    Return dict with the fields of log_entry for an archive.
+
+    With resolve_blobs, the extras blob and section references in the
+    change message are replaced by their content.
+    """
+    content_type = ContentType.objects.get_for_id(log_entry.content_type_id)
+    change_message = codec.decode(log_entry.change_message)
+    if resolve_blobs:
+        data = simplejson.loads(change_message)
+        if blobs.EXTRAS_BLOBS_KEY in data or blobs.SECTIONS_KEY in data:
+            change_message = simplejson.dumps(
+                blobs.resolve_extras(data),
+                cls=DateTimeAwareJSONEncoder,
+            )
+    return {
+        'id': log_entry.pk,
+        'action_time': log_entry.action_time,
+        'user_id': log_entry.user_id,
+        'content_type': '%s.%s' % (content_type.app_label, content_type.model),
+        'object_pk': get_storage().object_key(log_entry),
+        'object_repr': log_entry.object_repr,
+        'action_flag': log_entry.action_flag,
+        'change_message': change_message,
+    }
+
+
+class JsonLinesFile(object):
+    """
+    Gzip compressed JSON lines file that is appended to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, 'ab')
+
+    def write(self, record):
+        self._file.write(simplejson.dumps(
+            record,
+            cls=DateTimeAwareJSONEncoder,
+        ) + '\n')
+
+    def flush(self):
+        """
+        Flush the written records to disk, so they are readable.
+        """
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,139 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Baseline entries for objects that existed before their model was
+monitored.
+
+A baseline is an addition entry with the state of the object at the time
+of the backfill. Objects that already have an addition entry are
+skipped, so a backfill can be repeated. Integer pk ranges can be
+processed in parallel, see the history_backfill management command.
+"""
+from django.contrib.auth.models import User
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import get_model
+from django.utils.encoding import force_unicode
+
+from lizard_history import codec
+from lizard_history import groups
+from lizard_history import handlers
+from lizard_history import utils
+from lizard_history.storage import get_storage
+
+BASELINE_SUMMARY = 'Baseline snapshot'
+
+
+def pk_ranges(model, range_size):
+    """
+    Return list of (first pk, end pk) ranges that cover model's rows.
+
+    Models without integer pks get a single (None, None) range.
+    """
+    bounds = model.objects.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return []
+    if not isinstance(bounds['first'], (int, long)):
+        return [(None, None)]
+    return [(start, start + range_size) for start in range(
+        bounds['first'], bounds['last'] + 1, range_size,
+    )]
+
+
+def _baselined_keys(content_type_id, objs):
+    """
+    Return set of normalized pks of the objs with an addition entry.
+    """
+    storage = get_storage()
+    return set(
+        storage.values_object_key(row)
+        for row in storage.entries((utils.LIZARD_ADDITION,)).filter(
+            content_type=content_type_id,
+            **storage.objects_filter([obj.pk for obj in objs])
+        ).order_by().values(*storage.object_fields)
+    )
+
+
+def backfill_objects(objs, user_id, action_time, extras=False):
+    """
+    Write baseline entries for those of objs without an addition entry.
+
+    The objs must be of the same model and come from the database.
+    Return the number of entries written.
+    """
+    if not objs:
+        return 0
+    storage = get_storage()
+    content_type_id = utils.get_contenttype_id(objs[0])
+    baselined = _baselined_keys(content_type_id, objs)
+    handlers.add_m2m_many(objs)
+    # The custom extras are rendered for this user, there is no request.
+    user = User.objects.get(pk=user_id) if extras else None
+
+    log_entries = []
+    for obj in objs:
+        if storage.normalize_pk(obj.pk) in baselined:
+            continue
+        group = groups.group_for_object(obj)
+        if group is None:
+            object_repr = force_unicode(obj)
+        else:
+            object_repr = force_unicode(group.key(obj))
+        log_entries.append(storage.build(
+            action_time=action_time,
+            user_id=user_id,
+            content_type_id=content_type_id,
+            object_pk=obj.pk,
+            object_repr=object_repr,
+            action_flag=utils.LIZARD_ADDITION,
+            change_message=codec.encode(utils.change_message(
+                old_object=None,
+                new_object=obj,
+                summary=BASELINE_SUMMARY,
+                user=user,
+                extras=extras,
+            )),
+        ))
+    handlers.write_log_entries(log_entries)
+    return len(log_entries)
+
+
+def backfill_range(model, pk_range, chunk_size, user_id, action_time,
+                   extras=False):
+    """
+    Backfill the objects of model in pk_range, chunk_size at a time.
+
+    Return (number of objects, number of entries written).
+    """
+    first, end = pk_range
+    objects = model.objects.order_by('pk')
+    if first is not None:
+        objects = objects.filter(pk__gte=first, pk__lt=end)
+    count = written = 0
+    last_pk = None
+    while True:
+        chunk = objects
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        count += len(chunk)
+        written += backfill_objects(
+            chunk, user_id, action_time, extras=extras,
+        )
+    return count, written
+
+
+def backfill_task(args):
+    """
+    Run backfill_range in a worker process, for multiprocessing.
+
+    The args are the model in 'app_label.ObjectName' style, followed by
+    the other arguments of backfill_range.
+    """
+    model, pk_range, chunk_size, user_id, action_time, extras = args
+    return pk_range, backfill_range(
+        get_model(*model.split('.')), pk_range, chunk_size, user_id,
+        action_time, extras=extras,
+    )
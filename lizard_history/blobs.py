@@ -0,0 +1,121 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Content addressed storage of custom extras.
+
+With LIZARD_HISTORY_DEDUPLICATE_EXTRAS = True, the HISTORY_DATA_VIEW
+renderings in change messages are stored once in the ExtrasBlob table,
+keyed by the sha1 of their JSON. The change message then holds an
+'extras_blobs' dict that maps each extras key, such as 'api_object' or
+'tree', to its digest. Resolved blobs are kept in an LRU cache.
+
+With LIZARD_HISTORY_SPLIT_SECTIONS = True, each section of the
+api_object data, such as a grid of the wbconfiguration, is stored as a
+blob of its own. The change message then holds an 'api_object_sections'
+dict that maps the section names to their digests, so that a single
+section can be read without loading the others.
+"""
+import hashlib
+
+from django.conf import settings
+from django.utils import simplejson
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+
+from lizard_history import codec
+from lizard_history.lru import LRUCache
+
+EXTRAS_BLOBS_KEY = 'extras_blobs'
+SECTIONS_KEY = 'api_object_sections'
+
+DEDUPLICATE_EXTRAS = getattr(
+    settings, 'LIZARD_HISTORY_DEDUPLICATE_EXTRAS', False,
+)
+CACHE_SIZE = getattr(settings, 'LIZARD_HISTORY_BLOB_CACHE_SIZE', 100)
+SPLIT_SECTIONS = getattr(settings, 'LIZARD_HISTORY_SPLIT_SECTIONS', False)
+
+# Digest to parsed extras, filled on reads only. Writes can be rolled
+# back, so a digest in here does not mean the blob is stored.
+blob_cache = LRUCache(CACHE_SIZE)
+
+
+def store_extras(extras):
+    """
+    Store each value of extras as blob, return dict of digests.
+
+    Always asks the database, so that a blob whose insert was rolled back
+    is inserted again.
+    """
+    from lizard_history.models import ExtrasBlob
+    digests = {}
+    for key, value in extras.items():
+        data = simplejson.dumps(
+            value,
+            cls=DateTimeAwareJSONEncoder,
+            sort_keys=True,
+        )
+        digest = hashlib.sha1(data).hexdigest()
+        ExtrasBlob.objects.get_or_create(
+            digest=digest,
+            defaults={'data': codec.encode(data)},
+        )
+        digests[key] = digest
+    return digests
+
+
+def resolve_blob(digest):
+    """
+    Return the parsed extras stored under digest.
+
+    The result is shared through the cache and must not be modified.
+    """
+    from lizard_history.models import ExtrasBlob
+    value = blob_cache.get(digest)
+    if value is None:
+        blob = ExtrasBlob.objects.get(digest=digest)
+        value = simplejson.loads(codec.decode(blob.data))
+        blob_cache.set(digest, value)
+    return value
+
+
+def split_sections(extras):
+    """
+    Return extras without api_object data, and dict with section digests.
+
+    The sections of the api_object data are stored as blobs.
+    """
+    api_object = extras.get('api_object')
+    if not api_object or not isinstance(api_object.get('data'), dict):
+        return extras, {}
+    result = dict(extras)
+    result['api_object'] = dict(
+        (k, v) for k, v in api_object.items() if k != 'data'
+    )
+    return result, {SECTIONS_KEY: store_extras(api_object['data'])}
+
+
+def resolve_sections(data):
+    """
+    Replace the section references in message data by the api_object data.
+    """
+    digests = data.pop(SECTIONS_KEY, None)
+    if digests is not None:
+        api_object = dict(data.get('api_object', {}))
+        api_object['data'] = dict(
+            (name, resolve_blob(digest)) for name, digest in digests.items()
+        )
+        data['api_object'] = api_object
+    return data
+
+
+def resolve_extras(data, sections=True):
+    """
+    Replace the extras blob references in message data by their content.
+
+    Sections are only resolved if sections is True.
+    """
+    digests = data.pop(EXTRAS_BLOBS_KEY, None)
+    if digests:
+        for key, digest in digests.items():
+            data[key] = resolve_blob(digest)
+    if sections:
+        resolve_sections(data)
+    return data
@@ -0,0 +1,78 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Full snapshots in the change messages of long histories.
+
+Every LIZARD_HISTORY_CHECKPOINT_INTERVAL-th change of an object (default
+50, 0 disables) also stores the complete field values after the change,
+so that utils.get_state_at replays at most that many diffs.
+"""
+from django.conf import settings
+from django.db.models import Count
+from django.db.models import Model
+
+from lizard_history import utils
+from lizard_history.storage import get_storage
+
+CHECKPOINT_INTERVAL = getattr(
+    settings, 'LIZARD_HISTORY_CHECKPOINT_INTERVAL', 50,
+)
+
+
+def snapshot(obj):
+    """
+    Return the field values of obj, in the form of the diffs.
+    """
+    if not isinstance(obj, Model):
+        return None
+    result = {}
+    for k in utils._diff_keys(obj.__class__):
+        value = obj.__dict__.get(k, utils._MISSING)
+        result[k] = None if value is utils._MISSING else unicode(value)
+    return result
+
+
+def change_counts(objs):
+    """
+    Return dict of (content type id, object pk) to number of changes.
+
+    The object pks are normalized by the storage. Takes the counts from
+    the summary table if that is maintained, else counts the change
+    entries with one query per content type.
+    """
+    from lizard_history import summaries
+    storage = get_storage()
+    pks_per_content_type = {}
+    for obj in objs:
+        content_type_id = utils.get_contenttype_id(obj)
+        if content_type_id is not None:
+            pks_per_content_type.setdefault(content_type_id, set()).add(
+                storage.normalize_pk(obj.pk),
+            )
+
+    counts = {}
+    if summaries.SUMMARY_TABLE:
+        from lizard_history.models import HistorySummary
+        from lizard_history.models import summary_key
+        keys = dict(
+            (summary_key(content_type_id, pk), (content_type_id, pk))
+            for content_type_id, pks in pks_per_content_type.items()
+            for pk in pks
+        )
+        for key, change_count in HistorySummary.objects.filter(
+            key__in=keys.keys(),
+        ).values_list('key', 'change_count'):
+            counts[keys[key]] = change_count
+        return counts
+
+    for content_type_id, pks in pks_per_content_type.items():
+        # Without order_by(), the ordering fields end up in the GROUP BY.
+        rows = storage.entries((utils.LIZARD_CHANGE,)).filter(
+            content_type=content_type_id,
+            **storage.objects_filter(pks)
+        ).order_by().values(
+            *storage.object_fields
+        ).annotate(count=Count('pk'))
+        for row in rows:
+            counts[(content_type_id, storage.values_object_key(row))] = (
+                row['count'])
+    return counts
@@ -0,0 +1,145 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Coalescing of rapidly repeated changes.
+
+LIZARD_HISTORY_COALESCE maps models in 'app_label.ObjectName' style to a
+window in seconds. A change to an object of such a model is merged into
+the previous entry of the object if that entry is a change by the same
+user, written less than the window ago. The merged entry keeps the old
+values of the first change and gets the new values, custom extras and
+action time of the last one. Entries whose custom extras are pending
+are not merged. The previous entries are locked until the merged entries
+are written, so that concurrent changes to an object are not lost.
+"""
+import datetime
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.utils import simplejson
+
+from lizard_history import codec
+from lizard_history import utils
+from lizard_history.storage import get_storage
+
+COALESCE = getattr(settings, 'LIZARD_HISTORY_COALESCE', {})
+
+_windows = {}
+
+
+def window(content_type_id):
+    """
+    Return the coalescing window of content_type_id as timedelta, or None.
+    """
+    try:
+        return _windows[content_type_id]
+    except KeyError:
+        result = None
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is not None:
+            seconds = COALESCE.get(
+                model._meta.app_label + '.' + model._meta.object_name,
+            )
+            if seconds:
+                result = datetime.timedelta(seconds=seconds)
+        _windows[content_type_id] = result
+        return result
+
+
+def merge_messages(previous, message):
+    """
+    Return change message with the changes of message after previous.
+
+    Fields that are back at their old value are left out.
+    """
+    previous_data = simplejson.loads(codec.decode(previous))
+    data = simplejson.loads(codec.decode(message))
+
+    changes = previous_data['changes']
+    for k, v in data['changes'].items():
+        if k in changes:
+            changes[k]['new'] = v['new']
+            if changes[k]['old'] == changes[k]['new']:
+                del changes[k]
+        else:
+            changes[k] = v
+
+    checkpoint = previous_data.get(utils.CHECKPOINT_KEY)
+    if checkpoint is not None and not utils.CHECKPOINT_KEY in data:
+        for k, v in data['changes'].items():
+            checkpoint[k] = v['new']
+        data[utils.CHECKPOINT_KEY] = checkpoint
+    if 'summary' in previous_data and not 'summary' in data:
+        data['summary'] = previous_data['summary']
+    data['changes'] = changes
+    return codec.encode(simplejson.dumps(data))
+
+
+def _latest_entries(content_type_id, log_entries, since):
+    """
+    Return dict of object key to the latest stored entry since since.
+
+    The entries are selected for update.
+    """
+    storage = get_storage()
+    entries = storage.entries(utils.LIZARD_ACTIONS).filter(
+        content_type=content_type_id,
+        action_time__gte=since,
+        **storage.objects_filter(
+            [storage.object_key(e) for e in log_entries]
+        )
+    ).order_by('action_time', 'pk').select_for_update()
+    return dict((storage.object_key(e), e) for e in entries)
+
+
+def coalesce(log_entries):
+    """
+    Return (new entries, merged stored entries) for unsaved log_entries.
+
+    New entries may have been merged with each other. Does one query per
+    content type with a coalescing window. Call this in the transaction
+    that writes the entries, the stored entries stay locked until then.
+    """
+    storage = get_storage()
+    candidates = {}
+    for log_entry in log_entries:
+        if (log_entry.action_flag == utils.LIZARD_CHANGE and
+            window(log_entry.content_type_id) is not None):
+            candidates.setdefault(log_entry.content_type_id, []).append(
+                log_entry,
+            )
+    if not candidates:
+        return log_entries, []
+
+    latest = {}
+    for content_type_id, entries in candidates.items():
+        since = (min(e.action_time for e in entries) -
+                 window(content_type_id))
+        for object_key, log_entry in _latest_entries(
+            content_type_id, entries, since).items():
+            latest[(content_type_id, object_key)] = log_entry
+
+    new_entries = []
+    merged = {}
+    payload_field = storage.payload_field
+    for log_entry in sorted(log_entries, key=lambda e: e.action_time):
+        key = (log_entry.content_type_id, storage.object_key(log_entry))
+        previous = latest.get(key)
+        if (log_entry.content_type_id in candidates and
+            previous is not None and
+            previous.action_flag == utils.LIZARD_CHANGE and
+            previous.user_id == log_entry.user_id and
+            log_entry.action_time - previous.action_time <
+            window(log_entry.content_type_id) and
+            not utils.EXTRAS_PENDING_KEY in simplejson.loads(
+                codec.decode(previous.change_message))):
+            setattr(previous, payload_field, merge_messages(
+                previous.change_message, log_entry.change_message,
+            ))
+            previous.action_time = log_entry.action_time
+            previous.object_repr = log_entry.object_repr
+            if previous.pk is not None:
+                merged[previous.pk] = previous
+            continue
+        new_entries.append(log_entry)
+        latest[key] = log_entry
+    return new_entries, merged.values()
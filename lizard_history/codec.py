@@ -0,0 +1,57 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Encoding of change messages for storage.
+
+With LIZARD_HISTORY_COMPRESS = True, change messages longer than
+LIZARD_HISTORY_COMPRESS_THRESHOLD characters are stored zlib compressed
+and base64 encoded, behind a marker that includes a format version.
+Plain JSON messages never start with the marker, so old and new rows can
+be read side by side.
+"""
+import base64
+import zlib
+
+from django.conf import settings
+
+ZLIB_MARKER = 'lhz1:'
+
+COMPRESS = getattr(settings, 'LIZARD_HISTORY_COMPRESS', False)
+COMPRESS_THRESHOLD = getattr(
+    settings, 'LIZARD_HISTORY_COMPRESS_THRESHOLD', 4096,
+)
+COMPRESS_LEVEL = getattr(settings, 'LIZARD_HISTORY_COMPRESS_LEVEL', 6)
+
+
+def compress(message, level=COMPRESS_LEVEL):
+    """
+    Return message compressed behind ZLIB_MARKER.
+    """
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    return ZLIB_MARKER + base64.b64encode(zlib.compress(message, level))
+
+
+def encode(message, threshold=COMPRESS_THRESHOLD):
+    """
+    Return message as it should be stored.
+
+    Already encoded messages are returned as they are.
+    """
+    if (not COMPRESS or message is None or len(message) < threshold or
+        is_encoded(message)):
+        return message
+    return compress(message)
+
+
+def is_encoded(stored):
+    return stored.startswith(ZLIB_MARKER)
+
+
+def decode(stored):
+    """
+    Return the message for stored, which may be plain or encoded.
+    """
+    if not is_encoded(stored):
+        return stored
+    compressed = base64.b64decode(stored[len(ZLIB_MARKER):])
+    return zlib.decompress(compressed).decode('utf-8')
@@ -0,0 +1,84 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Registry of history groups.
+
+A group collapses all changed objects of its models that share a key,
+for example everything under one area, into a single entry per request.
+Only the representative object of each group is fetched, diffed and
+rendered: the changed object whose model comes first in the group's
+models. The key becomes the object_repr of the entry. The changes of the
+other members are not recorded, so the group's HISTORY_DATA_VIEW should
+render the whole group. Objects without a key, for example because of
+an empty foreign key on the key path, are logged ungrouped.
+
+Groups are declared in LIZARD_HISTORY_GROUPS, mapping a group name to
+its models and the attribute path of its key, or registered in code with
+register(). The default groups are the esf and wbconfiguration ones.
+"""
+import operator
+
+from django.conf import settings
+
+from lizard_history.utils import model_for_object
+
+DEFAULT_GROUPS = {
+    'lizard_esf': {
+        'models': (
+            'lizard_esf.AreaConfiguration',
+        ),
+        'key': 'area.ident',
+    },
+    'lizard_wbconfiguration': {
+        'models': (
+            'lizard_wbconfiguration.AreaConfiguration',
+            'lizard_wbconfiguration.Structure',
+            'lizard_wbconfiguration.Bucket',
+        ),
+        'key': 'area.area.ident',
+    },
+}
+
+
+class HistoryGroup(object):
+    """
+    Models whose changes are logged as one entry per key.
+
+    Models are in 'app_label.ObjectName' style, key is a callable that
+    takes an object or a dotted attribute path.
+    """
+    def __init__(self, name, models, key):
+        self.name = name
+        self.models = tuple(models)
+        if callable(key):
+            self.key = key
+        else:
+            self.key = operator.attrgetter(key)
+
+    def rank(self, obj):
+        """
+        Return rank of obj for choosing the representative, lowest wins.
+        """
+        return self.models.index(model_for_object(obj))
+
+
+_groups_per_model = {}
+
+
+def register(group):
+    """
+    Register group, replacing any group of the same models.
+    """
+    for model in group.models:
+        _groups_per_model[model] = group
+
+
+def group_for_object(obj):
+    """
+    Return the group obj belongs to, or None.
+    """
+    return _groups_per_model.get(model_for_object(obj))
+
+
+for name, declaration in getattr(
+    settings, 'LIZARD_HISTORY_GROUPS', DEFAULT_GROUPS).items():
+    register(HistoryGroup(name, declaration['models'], declaration['key']))
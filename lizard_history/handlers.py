@@ -1,25 +1,61 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from collections import defaultdict
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.base import ModelState
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+from django.utils import simplejson
+from django.utils import timezone
 from django.utils.encoding import force_unicode
+from django.utils.encoding import smart_str
 
-from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import User
+from lizard_history import checkpoints
+from lizard_history import codec
+from lizard_history import coalesce
+from lizard_history import groups
+from lizard_history import instrumentation
+from lizard_history import summaries
 from lizard_history import utils
+from lizard_history.storage import STORAGE
+from lizard_history.storage import get_storage
+from lizard_history import writer
+
+logger = logging.getLogger(__name__)
 
 OBJECT_ATTRIBUTE = '_lizard_history_hash'
 REQUEST_ATTRIBUTE = 'lizard_history'
 PRE_COPY_KEY = 'pre_copy'
 INSTANCE_KEY = 'instance'
 SIGNALS_KEY = 'signals'
+POST_COPY_KEY = 'post_copy'
+SUMMARY_KEY = 'summary'
+LAST_SIGNAL_KEY = 'last_signal'
+USER_ID_KEY = 'user_id'
+USER_KEY = 'user'
+ACTION_TIME_KEY = 'action_time'
+OBJECT_REPR_KEY = 'object_repr'
+CHANGES_KEY = 'changes'
+LOADED_STATE_ATTRIBUTE = '_lizard_history_loaded_state'
 
-
-ESF_MODELS = (
-    'lizard_esf.AreaConfiguration',
+# Use the field values an instance was loaded with as pre-image, instead
+# of fetching the pre-image from the database.
+TRACK_LOADED_STATE = getattr(
+    settings, 'LIZARD_HISTORY_TRACK_LOADED_STATE', False,
 )
 
-WBCONFIGURATION_MODELS = (
-    'lizard_wbconfiguration.AreaConfiguration',
-    'lizard_wbconfiguration.Structure',
-    'lizard_wbconfiguration.Bucket',
-)
+# Maximum number of pks in a single pk__in query.
+BATCH_SIZE = getattr(settings, 'LIZARD_HISTORY_BATCH_SIZE', 500)
+
+# Maximum number of log entries in a single INSERT.
+WRITE_BATCH_SIZE = getattr(settings, 'LIZARD_HISTORY_WRITE_BATCH_SIZE', 500)
+
+# Write entries without their custom extras, which are then computed by
+# the history_compute_extras management command.
+DEFER_EXTRAS = getattr(settings, 'LIZARD_HISTORY_DEFER_EXTRAS', False)
 
 
 def _get_or_create_history(obj):
@@ -44,6 +80,18 @@ def _get_or_create_history(obj):
     return history[obj_hash]
 
 
+def _add_m2m(db_copy):
+    """
+    Update db_copy's __dict__ with sorted pk lists of its m2m items.
+    """
+    for f in db_copy._meta._many_to_many():
+        field_pk_qs = getattr(db_copy, f.name).values_list('pk', flat=True)
+        field_pk_list = list(field_pk_qs)  # We must query right now.
+        field_pk_list.sort()
+        db_copy.__dict__.update({f.name: field_pk_list})
+
+
+@instrumentation.instrumented('pre_image')
 def _get_db_copy(obj):
     """
     Return database copy of obj.
@@ -57,16 +105,203 @@ def _get_db_copy(obj):
     except model.DoesNotExist:
         return None
 
-    # Add the m2m information
-    for f in db_copy._meta._many_to_many():
-        field_pk_qs = getattr(db_copy, f.name).values_list('pk', flat=True)
-        field_pk_list = list(field_pk_qs)  # We must query right now.
-        field_pk_list.sort()
-        db_copy.__dict__.update({f.name: field_pk_list})
+    _add_m2m(db_copy)
 
     return db_copy
 
 
+def _copy_key(obj):
+    return (obj.__class__, obj.pk)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def add_m2m_many(db_copies):
+    """
+    Like _add_m2m, for many copies of the same model.
+
+    Sets the m2m values to diff on the copies, which must be of the same
+    model. Does one query per m2m field, on the intermediate model.
+    """
+    model = db_copies[0].__class__
+    pks = [db_copy.pk for db_copy in db_copies]
+    for f in model._meta._many_to_many():
+        through = f.rel.through
+        source = f.m2m_field_name()
+        target = f.m2m_reverse_field_name()
+        field_pk_lists = defaultdict(list)
+        for chunk in _chunks(pks, BATCH_SIZE):
+            for source_pk, target_pk in through.objects.filter(
+                **{source + '__in': chunk}
+            ).values_list(source, target):
+                field_pk_lists[source_pk].append(target_pk)
+        for db_copy in db_copies:
+            field_pk_list = field_pk_lists.get(db_copy.pk, [])
+            field_pk_list.sort()
+            db_copy.__dict__.update({f.name: field_pk_list})
+
+
+@instrumentation.instrumented('db_copies')
+def _get_db_copies(objs):
+    """
+    Return dict of database copies of objs, keyed by _copy_key.
+
+    Does one query per model per BATCH_SIZE objects, and one per m2m
+    field, instead of one or more queries per object. Objects without a
+    pk or without a database row map to None.
+    """
+    pks_per_model = defaultdict(set)
+    result = {}
+    for obj in objs:
+        if obj.pk is None:
+            result[_copy_key(obj)] = None
+        else:
+            pks_per_model[obj.__class__].add(obj.pk)
+
+    for model, pks in pks_per_model.items():
+        pks = list(pks)
+        db_copies = []
+        for chunk in _chunks(pks, BATCH_SIZE):
+            db_copies.extend(model.objects.filter(pk__in=chunk))
+        if db_copies:
+            add_m2m_many(db_copies)
+        for pk in pks:
+            result[(model, pk)] = None
+        for db_copy in db_copies:
+            result[(model, db_copy.pk)] = db_copy
+
+    return result
+
+
+def capture_pre_images(objs):
+    """
+    Store the pre-images of objs on the active request in batch.
+
+    Call this before changing many objects that were not loaded from the
+    database in this request, to replace a query per object on its first
+    pre_save or pre_delete by a query per model.
+    """
+    if not utils.active_request():
+        return
+
+    pending = []
+    for obj in objs:
+        history = _get_or_create_history(obj)
+        history.setdefault(INSTANCE_KEY, obj)
+        if PRE_COPY_KEY in history:
+            continue
+        loaded_copy = None
+        if TRACK_LOADED_STATE:
+            loaded_copy = _get_loaded_copy(obj)
+        if loaded_copy is None:
+            pending.append((obj, history))
+        else:
+            history[PRE_COPY_KEY] = loaded_copy
+
+    db_copies = _get_db_copies([item[0] for item in pending])
+    for obj, history in pending:
+        history[PRE_COPY_KEY] = db_copies[_copy_key(obj)]
+
+
+def record_bulk_update(pre_copies):
+    """
+    Record a set based change of the rows of pre_copies on the request.
+
+    The pre_copies are the instances of one model as loaded before the
+    change, for example by a QuerySet.update(). Their new state is
+    fetched with the other post-images at the end of the request.
+    """
+    if not utils.active_request() or not pre_copies:
+        return
+
+    add_m2m_many(pre_copies)
+    for pre_copy in pre_copies:
+        history = _get_or_create_history(pre_copy)
+        history[PRE_COPY_KEY] = pre_copy
+        history[SIGNALS_KEY].append('post_save')
+        history[INSTANCE_KEY] = pre_copy
+
+
+def record_bulk_create(objs):
+    """
+    Record the creation of objs, for example by bulk_create, on the request.
+
+    Objects without a pk cannot be found again and are not recorded.
+    """
+    if not utils.active_request():
+        return
+
+    for obj in objs:
+        if obj.pk is None:
+            continue
+        history = _get_or_create_history(obj)
+        history.setdefault(PRE_COPY_KEY, None)
+        history[SIGNALS_KEY].append('post_save')
+        history[INSTANCE_KEY] = obj
+
+
+def store_loaded_state(instance):
+    """
+    Record the concrete field values of instance on the instance.
+
+    Instances with deferred fields get no loaded state.
+    """
+    try:
+        state = tuple(instance.__dict__[f.attname]
+                      for f in instance._meta.fields)
+    except KeyError:
+        return
+    instance.__dict__[LOADED_STATE_ATTRIBUTE] = state
+
+
+def clear_loaded_state(instance):
+    instance.__dict__.pop(LOADED_STATE_ATTRIBUTE, None)
+
+
+def _get_loaded_copy(obj):
+    """
+    Return copy of obj built from its loaded state, or None.
+
+    Only instances that were loaded from or saved to the database have a
+    usable loaded state. Does no query, except for the m2m items.
+    """
+    state = obj.__dict__.get(LOADED_STATE_ATTRIBUTE)
+    if state is None or obj._state.adding:
+        return None
+
+    model = obj.__class__
+    attnames = [f.attname for f in model._meta.fields]
+    values = dict(zip(attnames, state))
+    if values[model._meta.pk.attname] != obj.pk:
+        return None  # The pk was changed, the state is not about this row.
+
+    loaded_copy = model.__new__(model)
+    loaded_copy.__dict__.update(values)
+    loaded_copy._state = ModelState(obj._state.db)
+    loaded_copy._state.adding = False
+
+    _add_m2m(loaded_copy)
+
+    return loaded_copy
+
+
+def _get_pre_copy(obj):
+    """
+    Return the pre-image of obj, from its loaded state if possible.
+    """
+    if obj.pk is None:
+        return None
+    if TRACK_LOADED_STATE:
+        loaded_copy = _get_loaded_copy(obj)
+        if loaded_copy is not None:
+            return loaded_copy
+    return _get_db_copy(obj)
+
+
+@instrumentation.instrumented('db_handler')
 def db_handler(sender, instance, signal_name, raw=None, **kwargs):
     """
     Store old and new objects on the active request.
@@ -80,76 +315,400 @@ def db_handler(sender, instance, signal_name, raw=None, **kwargs):
 
     # Store initial status of the object on the request.
     if signal_name.startswith('pre_') and not PRE_COPY_KEY in history:
-        history[PRE_COPY_KEY] = _get_db_copy(instance)
+        history[PRE_COPY_KEY] = _get_pre_copy(instance)
 
 
-def process_request_handler(**kwargs):
+def _insert_log_entries(log_entries, pending_entries, merged_entries):
+    storage = get_storage()
+    for chunk in _chunks(log_entries, WRITE_BATCH_SIZE):
+        storage.bulk_create(chunk)
+
+    for log_entry in merged_entries:
+        storage.model.objects.filter(pk=log_entry.pk).update(**{
+            'action_time': log_entry.action_time,
+            'object_repr': log_entry.object_repr,
+            storage.payload_field: log_entry.change_message,
+        })
+
+    if pending_entries:
+        from lizard_history.models import PendingExtras
+        # Saved one by one, since bulk_create does not set the pks.
+        for log_entry in pending_entries:
+            log_entry.save()
+        PendingExtras.objects.bulk_create([
+            PendingExtras(storage=STORAGE, entry_id=log_entry.pk)
+            for log_entry in pending_entries
+        ])
+
+    if summaries.SUMMARY_TABLE:
+        summaries.update_summaries(
+            list(log_entries) + list(pending_entries),
+            merged_entries=merged_entries,
+        )
+
+
+@instrumentation.instrumented('write')
+def write_log_entries(log_entries, pending_entries=(), merged_entries=()):
     """
-    Log any changes recorded on the request object.
+    Insert log_entries using one INSERT per WRITE_BATCH_SIZE entries.
+
+    The pending_entries, whose custom extras are still to be computed,
+    are inserted one by one and registered as PendingExtras. The
+    merged_entries, see coalesce, are updated. All share a transaction.
+    If a transaction is already being managed, for example by django's
+    TransactionMiddleware, that one is used.
     """
-    if not hasattr(utils.active_request(), REQUEST_ATTRIBUTE):
+    if not log_entries and not pending_entries and not merged_entries:
         return
-    try:
-        actions = getattr(utils.active_request(), REQUEST_ATTRIBUTE).values()
-    except AttributeError:
+
+    if transaction.is_managed():
+        _insert_log_entries(log_entries, pending_entries, merged_entries)
         return
 
-    logged_models = set()
+    with transaction.commit_on_success():
+        _insert_log_entries(log_entries, pending_entries, merged_entries)
+
 
-    for action in actions:
+def _capture_record():
+    """
+    Return a record of the changes on the active request, or None.
+
+    Does everything that needs the request: collapsing grouped objects,
+    fetching the post-images and determining the user. The history is
+    removed from the request.
+    """
+    try:
+        history = getattr(utils.active_request(), REQUEST_ATTRIBUTE)
+    except AttributeError:
+        return None
+    delattr(utils.active_request(), REQUEST_ATTRIBUTE)
 
-        pre_copy = action[PRE_COPY_KEY]
-        post_copy = _get_db_copy(action[INSTANCE_KEY])
+    actions = []
+    grouped_actions = {}
+    for action in history.values():
         signals = [s for s in action[SIGNALS_KEY]
                    if s in ('post_save', 'post_delete')]
-        if len(signals) <= 0:
+        if not signals:
             continue
-            
-        last_signal = signals[-1]
+        instance = action[INSTANCE_KEY]
+        group = groups.group_for_object(instance)
+        if group is None:
+            actions.append((action, signals[-1], None))
+            continue
+        try:
+            key = force_unicode(group.key(instance))
+        except AttributeError:
+            # For example an empty foreign key on the key path.
+            logger.warning('No history group key for %r, logged ungrouped.',
+                           instance)
+            actions.append((action, signals[-1], None))
+            continue
+        # Only the representative of each group and key is kept.
+        current = grouped_actions.get((group.name, key))
+        if (current is None or
+            group.rank(instance) < group.rank(current[0][INSTANCE_KEY])):
+            grouped_actions[(group.name, key)] = (action, signals[-1], key)
+    actions.extend(grouped_actions.values())
+    if not actions:
+        return None
+
+    post_copies = _get_db_copies(
+        [item[0][INSTANCE_KEY] for item in actions],
+    )
+
+    changes = []
+    for action, last_signal, key in actions:
+        instance = action[INSTANCE_KEY]
+        changes.append({
+            PRE_COPY_KEY: action.get(PRE_COPY_KEY),
+            POST_COPY_KEY: post_copies[_copy_key(instance)],
+            SUMMARY_KEY: getattr(instance, 'lizard_history_summary', None),
+            LAST_SIGNAL_KEY: last_signal,
+            OBJECT_REPR_KEY: key,
+        })
+    instrumentation.add('objects', len(changes))
+
+    return {
+        USER_ID_KEY: utils.user_pk(),
+        USER_KEY: (getattr(utils.active_request(), 'user', None) or
+                   AnonymousUser()),
+        ACTION_TIME_KEY: timezone.now(),
+        CHANGES_KEY: changes,
+    }
+
+
+def _compact_copy(obj):
+    """
+    Return (model, db, values) with only the diffed values of obj.
+
+    Drops the caches of related objects and other instance attributes.
+    """
+    if obj is None:
+        return None
+    model = obj.__class__
+    values = dict((k, obj.__dict__[k])
+                  for k in utils._diff_keys(model) if k in obj.__dict__)
+    return model, obj._state.db, values
+
+
+def _expand_copy(compact_copy):
+    """
+    Return an instance built from the result of _compact_copy.
+    """
+    if compact_copy is None:
+        return None
+    model, db, values = compact_copy
+    obj = model.__new__(model)
+    obj.__dict__.update(values)
+    obj._state = ModelState(db)
+    obj._state.adding = False
+    return obj
+
+
+def compact_record(record):
+    """
+    Return a copy of record that holds no model instances.
+
+    Used to keep the records on the queue of the asynchronous writer
+    small. The user is replaced by its pk, or None if anonymous.
+    """
+    user = record[USER_KEY]
+    compact = dict(record)
+    compact[USER_KEY] = user.pk if user.is_authenticated() else None
+    compact[CHANGES_KEY] = [
+        dict(change, **{
+            PRE_COPY_KEY: _compact_copy(change[PRE_COPY_KEY]),
+            POST_COPY_KEY: _compact_copy(change[POST_COPY_KEY]),
+        })
+        for change in record[CHANGES_KEY]
+    ]
+    return compact
+
+
+def _expand_records(records):
+    """
+    Return the records that compact_record made, with instances again.
+    """
+    user_pks = set(record[USER_KEY] for record in records
+                   if record[USER_KEY] is not None)
+    users = User.objects.in_bulk(list(user_pks)) if user_pks else {}
+
+    expanded = []
+    for record in records:
+        record = dict(record)
+        record[USER_KEY] = users.get(record[USER_KEY]) or AnonymousUser()
+        record[CHANGES_KEY] = [
+            dict(change, **{
+                PRE_COPY_KEY: _expand_copy(change[PRE_COPY_KEY]),
+                POST_COPY_KEY: _expand_copy(change[POST_COPY_KEY]),
+            })
+            for change in record[CHANGES_KEY]
+        ]
+        expanded.append(record)
+    return expanded
+
+
+def _record_log_entries(record, change_counts=None):
+    """
+    Return unsaved log entries and pending entries for record.
+
+    Does the diffing and the rendering of the custom extras, so this does
+    not need the request and can run in another thread. With DEFER_EXTRAS,
+    entries of objects with a HISTORY_DATA_VIEW are returned as pending
+    entries, without their custom extras. If change_counts are given, see
+    checkpoints.change_counts, they are updated and every
+    CHECKPOINT_INTERVAL-th change gets a checkpoint.
+    """
+    log_entries = []
+    pending_entries = []
+
+    for change in record[CHANGES_KEY]:
+
+        pre_copy = change[PRE_COPY_KEY]
+        post_copy = change[POST_COPY_KEY]
 
-        if last_signal == 'post_save':
+        if change[LAST_SIGNAL_KEY] == 'post_save':
             obj = post_copy
             action_flag = (utils.LIZARD_CHANGE if pre_copy else
                            utils.LIZARD_ADDITION)
-        elif last_signal == 'post_delete':
+        else:
             obj = pre_copy
             action_flag = utils.LIZARD_DELETION
-        else:
-            continue
 
-        # Custom handling starts here
-        if utils.is_object_of(obj, ESF_MODELS):
-            if logged_models.intersection(ESF_MODELS):
-                continue  # Already logged the esf data
-            else:
-                object_repr = obj.area.ident
-        elif utils.is_object_of(obj, WBCONFIGURATION_MODELS):
-            if logged_models.intersection(WBCONFIGURATION_MODELS):
-                continue  # Already logged the wbconfiguration data
-            else:
-                object_repr = obj.area.area.ident
-        # Custom handling starts ends here
-        else:
+        if obj is None:
+            continue  # Saved and deleted again, or deleted twice.
+
+        # Grouped objects are represented by their group key.
+        object_repr = change[OBJECT_REPR_KEY]
+        if object_repr is None:
             object_repr = force_unicode(obj)
 
+        checkpoint = None
+        count_change = (action_flag == utils.LIZARD_CHANGE and
+                        change_counts is not None)
+        if count_change:
+            count_key = (utils.get_contenttype_id(obj),
+                         get_storage().normalize_pk(obj.pk))
+            count = change_counts.get(count_key, 0) + 1
+            if count % checkpoints.CHECKPOINT_INTERVAL == 0:
+                checkpoint = checkpoints.snapshot(post_copy)
+
+        defer_extras = (DEFER_EXTRAS and
+                        hasattr(post_copy, 'HISTORY_DATA_VIEW'))
         change_message = utils.change_message(
             old_object=pre_copy,
             new_object=post_copy,
-            instance=action['instance'],
+            summary=change[SUMMARY_KEY],
+            user=record[USER_KEY],
+            defer_extras=defer_extras,
+            checkpoint=checkpoint,
         )
 
         # Don't log if nothing was changed.
         if change_message is None:
-            return
+            continue
+        if count_change:
+            change_counts[count_key] = count
 
-        # Insert a log entry in django's admin log.
-        LogEntry.objects.log_action(
-            user_id=utils.user_pk(),
+        # Collect a log entry for the history storage.
+        change_message = codec.encode(change_message)
+        if instrumentation.INSTRUMENT:
+            instrumentation.add('payload_bytes',
+                                len(smart_str(change_message)))
+        entries = pending_entries if defer_extras else log_entries
+        entries.append(get_storage().build(
+            action_time=record[ACTION_TIME_KEY],
+            user_id=record[USER_ID_KEY],
             content_type_id=utils.get_contenttype_id(obj),
-            object_id=obj.pk,
+            object_pk=obj.pk,
             object_repr=object_repr,
             action_flag=action_flag,
             change_message=change_message,
+        ))
+
+    return log_entries, pending_entries
+
+
+def write_records(records):
+    """
+    Diff and store the changes of records with bulk inserts.
+    """
+    change_counts = None
+    if checkpoints.CHECKPOINT_INTERVAL:
+        change_counts = checkpoints.change_counts([
+            change[POST_COPY_KEY]
+            for record in records
+            for change in record[CHANGES_KEY]
+            if change[LAST_SIGNAL_KEY] == 'post_save' and
+            change[PRE_COPY_KEY] is not None and
+            change[POST_COPY_KEY] is not None
+        ])
+
+    log_entries = []
+    pending_entries = []
+    for record in records:
+        record_log_entries, record_pending_entries = _record_log_entries(
+            record, change_counts,
         )
+        log_entries.extend(record_log_entries)
+        pending_entries.extend(record_pending_entries)
+
+    if not coalesce.COALESCE:
+        write_log_entries(log_entries, pending_entries)
+        return
+
+    # The merged entries are read and written in the same transaction.
+    if transaction.is_managed():
+        _coalesce_log_entries(log_entries, pending_entries)
+        return
+
+    with transaction.commit_on_success():
+        _coalesce_log_entries(log_entries, pending_entries)
+
+
+def _coalesce_log_entries(log_entries, pending_entries):
+    log_entries, merged_entries = coalesce.coalesce(log_entries)
+    write_log_entries(log_entries, pending_entries, merged_entries)
+
 
-        logged_models.add(utils.model_for_object(obj))
+def write_compact_records(records):
+    """
+    Write records that were made by compact_record.
+    """
+    write_records(_expand_records(records))
+
+
+def compute_pending_extras(batch_size=100):
+    """
+    Add the custom extras to a batch of pending entries.
+
+    Return the number of pending entries handled. The extras reflect the
+    state of the object at the time this runs, not at the time of the
+    change. Entries whose object no longer exists get EXTRAS_MISSING_KEY
+    instead of extras. Each pending entry is locked while it is handled,
+    so that several processes can run this side by side.
+    """
+    from lizard_history.models import PendingExtras
+    pending_list = list(PendingExtras.objects.order_by('pk')[:batch_size])
+
+    handled = 0
+    for pending in pending_list:
+        storage = get_storage(pending.storage)
+        with transaction.commit_on_success():
+            if not PendingExtras.objects.select_for_update().filter(
+                pk=pending.pk,
+            ).exists():
+                continue  # Handled by another process meanwhile.
+            handled += 1
+            try:
+                log_entry = storage.model.objects.select_related(
+                    'content_type', 'user',
+                ).get(pk=pending.entry_id)
+            except storage.model.DoesNotExist:
+                pending.delete()
+                continue
+
+            data = simplejson.loads(codec.decode(log_entry.change_message))
+            data.pop(utils.EXTRAS_PENDING_KEY, None)
+            obj = None
+            model = log_entry.content_type.model_class()
+            if model is not None:  # Else the model is gone.
+                try:
+                    obj = model.objects.get(pk=storage.object_key(log_entry))
+                except model.DoesNotExist:
+                    pass
+            if obj is None:
+                data[utils.EXTRAS_MISSING_KEY] = True
+            else:
+                data.update(utils.extras_for_storage(
+                    utils._custom_extras(obj, user=log_entry.user),
+                ))
+
+            storage.model.objects.filter(pk=log_entry.pk).update(**{
+                storage.payload_field: codec.encode(simplejson.dumps(
+                    data,
+                    cls=DateTimeAwareJSONEncoder,
+                )),
+            })
+            pending.delete()
+
+    return handled
+
+
+def process_request_handler(**kwargs):
+    """
+    Log any changes recorded on the request object.
+
+    With an asynchronous writer the request only captures the changes.
+    """
+    try:
+        record = _capture_record()
+        if record is None:
+            return
+
+        if writer.ASYNC:
+            writer.get_writer().submit(compact_record(record))
+        else:
+            write_records([record])
+    finally:
+        instrumentation.finish_request()
@@ -0,0 +1,181 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Measurement of the overhead of lizard_history.
+
+With LIZARD_HISTORY_INSTRUMENT = True, the instrumented phases record
+their wall time and number of queries in the process wide stats. Phases
+in a request are also summed per request, together with the number of
+captured objects and the payload bytes written. At the end of the
+request the totals are logged, as a warning if the time spent in the
+outermost phases exceeds LIZARD_HISTORY_INSTRUMENT_THRESHOLD
+milliseconds (default 100), and added to the stats.
+
+Queries are counted with django's debug cursor, which is switched on
+during the phases only. Unless it was on already, or DEBUG is on, the
+queries of the phases are not kept in connection.queries.
+"""
+from collections import deque
+import functools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENT = getattr(settings, 'LIZARD_HISTORY_INSTRUMENT', False)
+THRESHOLD = getattr(settings, 'LIZARD_HISTORY_INSTRUMENT_THRESHOLD', 100)
+# Number of most recent samples per metric that the stats are based on.
+MAX_SAMPLES = getattr(settings, 'LIZARD_HISTORY_INSTRUMENT_SAMPLES', 1000)
+
+REQUEST_ATTRIBUTE = 'lizard_history_instrumentation'
+OVERHEAD = 'overhead_ms'
+
+_local = threading.local()
+
+
+class Stats(object):
+    """
+    Thread safe samples per metric, with percentiles.
+    """
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, metric, value):
+        with self._lock:
+            try:
+                samples = self._samples[metric]
+            except KeyError:
+                samples = self._samples[metric] = deque(
+                    maxlen=self.max_samples,
+                )
+            samples.append(value)
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+    def summary(self):
+        """
+        Return dict of metric to count, mean, max and percentiles.
+        """
+        with self._lock:
+            samples_per_metric = dict(
+                (metric, sorted(samples))
+                for metric, samples in self._samples.items()
+            )
+        result = {}
+        for metric, samples in samples_per_metric.items():
+            count = len(samples)
+            result[metric] = {
+                'count': count,
+                'mean': sum(samples) / float(count),
+                'p50': samples[int(0.50 * (count - 1))],
+                'p90': samples[int(0.90 * (count - 1))],
+                'p99': samples[int(0.99 * (count - 1))],
+                'max': samples[-1],
+            }
+        return result
+
+
+stats = Stats()
+
+
+def _request_totals():
+    """
+    Return the totals dict of the active request, or None.
+    """
+    from lizard_history import utils
+    request = utils.active_request()
+    if not request:
+        return None
+    totals = getattr(request, REQUEST_ATTRIBUTE, None)
+    if totals is None:
+        totals = {}
+        setattr(request, REQUEST_ATTRIBUTE, totals)
+    return totals
+
+
+def add(metric, value):
+    """
+    Add value to metric of the active request, or to the stats.
+    """
+    if not INSTRUMENT:
+        return
+    totals = _request_totals()
+    if totals is None:
+        stats.add(metric, value)
+    else:
+        totals[metric] = totals.get(metric, 0) + value
+
+
+def instrumented(name):
+    """
+    Decorate a function as phase name, if INSTRUMENT is on.
+
+    Times and query counts include those of nested phases.
+    """
+    def decorator(func):
+        if not INSTRUMENT:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            depth = getattr(_local, 'depth', 0)
+            use_debug_cursor = connection.use_debug_cursor
+            # See BaseDatabaseWrapper.cursor().
+            recording = use_debug_cursor or (
+                use_debug_cursor is None and settings.DEBUG)
+            connection.use_debug_cursor = True
+            start_queries = len(connection.queries)
+            start = time.time()
+            _local.depth = depth + 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _local.depth = depth
+                elapsed = (time.time() - start) * 1000
+                queries = len(connection.queries) - start_queries
+                connection.use_debug_cursor = use_debug_cursor
+                if not recording:
+                    del connection.queries[start_queries:]
+                stats.add(name + '.ms', elapsed)
+                stats.add(name + '.queries', queries)
+                totals = _request_totals()
+                if totals is not None:
+                    totals[name + '.ms'] = (
+                        totals.get(name + '.ms', 0) + elapsed)
+                    totals[name + '.queries'] = (
+                        totals.get(name + '.queries', 0) + queries)
+                    if depth == 0:
+                        totals[OVERHEAD] = totals.get(OVERHEAD, 0) + elapsed
+        return wrapper
+    return decorator
+
+
+def finish_request():
+    """
+    Log the totals of the active request and add them to the stats.
+    """
+    if not INSTRUMENT:
+        return
+    from lizard_history import utils
+    request = utils.active_request()
+    totals = getattr(request, REQUEST_ATTRIBUTE, None)
+    if not totals:
+        return
+    delattr(request, REQUEST_ATTRIBUTE)
+
+    for metric, value in totals.items():
+        stats.add('request.' + metric, value)
+    level = logging.DEBUG
+    if totals.get(OVERHEAD, 0) >= THRESHOLD:
+        level = logging.WARNING
+    logger.log(level, 'lizard_history request overhead: %s', ', '.join(
+        '%s=%s' % (metric, round(value, 1))
+        for metric, value in sorted(totals.items())
+    ))
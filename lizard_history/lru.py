@@ -0,0 +1,52 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """
+    Thread safe, bounded, least recently used cache with hit counters.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value  # Move to the most recent end.
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,101 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Write baseline entries for the existing objects of a monitored model.
+
+The pk space of the model is split into ranges of --range-size pks,
+which are processed by --processes worker processes. Objects that
+already have an addition entry are skipped, so an interrupted backfill
+can simply be started again. Do not run two backfills of the same model
+at the same time.
+"""
+from optparse import make_option
+import multiprocessing
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import get_model
+from django.utils import timezone
+
+from lizard_history import backfill
+from lizard_history import utils
+from lizard_history.registry import registry
+
+
+class Command(BaseCommand):
+    args = '<app_label.ObjectName>'
+    help = "Write baseline history entries for existing objects."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes',
+                    dest='processes',
+                    type='int',
+                    default=multiprocessing.cpu_count(),
+                    help='Number of worker processes'),
+        make_option('--range-size',
+                    dest='range_size',
+                    type='int',
+                    default=10000,
+                    help='Number of pks per task'),
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=500,
+                    help='Number of objects per insert'),
+        make_option('--user',
+                    dest='user',
+                    default=None,
+                    help='Username for the entries, default a superuser'),
+        make_option('--with-extras',
+                    dest='extras',
+                    action='store_true',
+                    default=False,
+                    help='Render the custom extras of every object'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0].count('.') != 1:
+            raise CommandError('Supply the model as app_label.ObjectName.')
+        model = get_model(*args[0].split('.'))
+        if model is None:
+            raise CommandError('No such model: %s' % args[0])
+        if not registry.is_monitored(model):
+            raise CommandError('Model %s is not monitored.' % args[0])
+
+        if options['user']:
+            try:
+                user_id = User.objects.get(username=options['user']).pk
+            except User.DoesNotExist:
+                raise CommandError('No such user: %s' % options['user'])
+        else:
+            user_id = utils.fallback_user_pk()
+
+        action_time = timezone.now()
+        ranges = backfill.pk_ranges(model, options['range_size'])
+        tasks = [(args[0], pk_range, options['chunk_size'], user_id,
+                  action_time, options['extras']) for pk_range in ranges]
+
+        if options['processes'] > 1 and len(tasks) > 1:
+            # The workers must not share the connection of this process.
+            connection.close()
+            pool = multiprocessing.Pool(options['processes'])
+            results = pool.imap_unordered(backfill.backfill_task, tasks)
+        else:
+            pool = None
+            results = (backfill.backfill_task(task) for task in tasks)
+
+        done = objects = written = 0
+        try:
+            for pk_range, (count, range_written) in results:
+                done += 1
+                objects += count
+                written += range_written
+                self.stdout.write(
+                    '%s/%s ranges, %s objects, %s baselines written\n' % (
+                        done, len(tasks), objects, written,
+                    ))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
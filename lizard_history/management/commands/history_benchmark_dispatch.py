@@ -0,0 +1,81 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Compare the per-save signal overhead on an unmonitored model between the
+'global' and the 'sender' dispatch mode.
+
+Only the signals are sent, no queries are done, so that the numbers are
+not drowned in database noise. Usage::
+
+    bin/django history_benchmark_dispatch --model=sessions.Session
+"""
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import models as django_models
+
+from lizard_history import models
+from lizard_history import registry
+
+
+class Command(BaseCommand):
+    help = ("Benchmark per-save signal overhead on an unmonitored model "
+            "for both dispatch modes.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--model',
+                    dest='model',
+                    default='sessions.Session',
+                    help='Unmonitored model as app_label.ModelName'),
+        make_option('--iterations',
+                    dest='iterations',
+                    type='int',
+                    default=100000,
+                    help='Number of simulated saves per mode'),
+    )
+
+    def _time_saves(self, model, iterations):
+        instance = model()
+        start = time.time()
+        for i in xrange(iterations):
+            django_models.signals.pre_save.send(
+                sender=model, instance=instance, raw=False,
+            )
+            django_models.signals.post_save.send(
+                sender=model, instance=instance, created=False, raw=False,
+            )
+        return (time.time() - start) / iterations
+
+    def handle(self, *args, **options):
+        app_label, model_name = options['model'].split('.')
+        model = django_models.get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model %s' % options['model'])
+        if registry.registry.is_monitored(model):
+            raise CommandError('%s is monitored' % options['model'])
+        iterations = options['iterations']
+
+        results = []
+        try:
+            models.disconnect_receivers()
+            models.connect_global_receivers()
+            results.append(('global', self._time_saves(model, iterations)))
+            models.disconnect_receivers()
+            models.connect_monitored_senders()
+            results.append(('sender', self._time_saves(model, iterations)))
+        finally:
+            models.disconnect_receivers()
+            if models.DISPATCH == models.SENDER_DISPATCH:
+                models.connect_monitored_senders()
+            else:
+                models.connect_global_receivers()
+
+        for mode, seconds in results:
+            self.stdout.write('%-6s dispatch: %.2f us per save\n' % (
+                mode, seconds * 1e6,
+            ))
+        if results[1][1]:
+            self.stdout.write('speedup: %.1fx\n' % (
+                results[0][1] / results[1][1],
+            ))
@@ -0,0 +1,82 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Report the space compression would save on a sample of the history.
+
+The sample consists of the most recent entries. Usage::
+
+    bin/django history_compression_report --sample=1000 --threshold=4096
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lizard_history import codec
+from lizard_history import storage
+from lizard_history import utils
+
+
+class Command(BaseCommand):
+    help = "Report the space saved by compressing history payloads."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sample',
+                    dest='sample',
+                    type='int',
+                    default=1000,
+                    help='Number of most recent entries to examine'),
+        make_option('--threshold',
+                    dest='threshold',
+                    type='int',
+                    default=codec.COMPRESS_THRESHOLD,
+                    help='Minimum message length to compress'),
+    )
+
+    def handle(self, *args, **options):
+        history_storage = storage.get_storage()
+        payloads = history_storage.entries(utils.LIZARD_ACTIONS).order_by(
+            '-pk',
+        ).values_list(
+            history_storage.payload_field, flat=True,
+        )[:options['sample']]
+
+        rows = 0
+        compressed_rows = 0
+        already_compressed = 0
+        stored_bytes = 0
+        plain_bytes = 0
+        encoded_bytes = 0
+        for payload in payloads.iterator():
+            rows += 1
+            stored_bytes += _byte_size(payload)
+            if codec.is_encoded(payload):
+                already_compressed += 1
+                payload = codec.decode(payload)
+            size = _byte_size(payload)
+            plain_bytes += size
+            if len(payload) >= options['threshold']:
+                compressed_rows += 1
+                encoded_bytes += len(codec.compress(payload))
+            else:
+                encoded_bytes += size
+
+        self.stdout.write('Examined rows: %s\n' % rows)
+        self.stdout.write('Rows already compressed: %s\n' %
+                          already_compressed)
+        self.stdout.write('Rows above threshold: %s\n' % compressed_rows)
+        self.stdout.write('Stored bytes: %s\n' % stored_bytes)
+        self.stdout.write('Uncompressed bytes: %s\n' % plain_bytes)
+        self.stdout.write('Compressed bytes: %s\n' % encoded_bytes)
+        if plain_bytes:
+            self.stdout.write('Saved: %s bytes (%.1f%%)\n' % (
+                plain_bytes - encoded_bytes,
+                100.0 * (plain_bytes - encoded_bytes) / plain_bytes,
+            ))
+
+
+def _byte_size(payload):
+    """
+    Return the size of payload in bytes, utf-8 encoded.
+    """
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    return len(payload)
@@ -0,0 +1,49 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Compute the custom extras of entries written with
+LIZARD_HISTORY_DEFER_EXTRAS. Run it from cron, or keep it running as a
+worker with --loop. Pending entries are locked while they are handled,
+so several instances can run side by side.
+"""
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from lizard_history import handlers
+
+
+class Command(BaseCommand):
+    help = "Compute the custom extras of pending history entries."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=100,
+                    help='Number of pending entries per batch'),
+        make_option('--loop',
+                    dest='loop',
+                    action='store_true',
+                    default=False,
+                    help='Keep waiting for new pending entries'),
+        make_option('--sleep',
+                    dest='sleep',
+                    type='float',
+                    default=5,
+                    help='Seconds to wait when nothing is pending'),
+    )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            handled = handlers.compute_pending_extras(
+                batch_size=options['batch_size'],
+            )
+            total += handled
+            if handled:
+                self.stdout.write('Computed extras for %s entries\n' % total)
+            elif options['loop']:
+                time.sleep(options['sleep'])
+            else:
+                break
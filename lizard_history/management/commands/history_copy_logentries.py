@@ -0,0 +1,97 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Copy the lizard_history entries from django's LogEntry to HistoryEntry.
+
+Rows are copied in chunks in order of their LogEntry id, each chunk in
+its own transaction. Rows that were copied before, recognized by their
+object, action time and action, are skipped, so the command can be run
+again after an interruption. The last copied id is reported after every
+chunk, so an interrupted copy can also be resumed with --start-id.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lizard_history import storage
+from lizard_history import utils
+
+
+class Command(BaseCommand):
+    help = "Copy lizard_history LogEntry rows to the HistoryEntry table."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=1000,
+                    help='Number of rows per chunk'),
+        make_option('--start-id',
+                    dest='start_id',
+                    type='int',
+                    default=0,
+                    help='Only copy LogEntry rows with a larger id'),
+    )
+
+    def handle(self, *args, **options):
+        source = storage.get_storage(storage.LOGENTRY_STORAGE)
+        target = storage.get_storage(storage.HISTORYENTRY_STORAGE)
+        chunk_size = options['chunk_size']
+        last_id = options['start_id']
+        copied = 0
+        skipped = 0
+
+        while True:
+            rows = list(source.entries(utils.LIZARD_ACTIONS).filter(
+                pk__gt=last_id,
+            ).order_by('pk').values_list(
+                'pk', 'action_time', 'user_id', 'content_type_id',
+                'object_id', 'object_repr', 'action_flag', 'change_message',
+            )[:chunk_size])
+            if not rows:
+                break
+
+            with transaction.commit_on_success():
+                existing = _existing_keys(target, rows)
+                entries = [target.build(
+                    action_time=action_time,
+                    user_id=user_id,
+                    content_type_id=content_type_id,
+                    object_pk=object_id,
+                    object_repr=object_repr,
+                    action_flag=action_flag,
+                    change_message=change_message,
+                ) for (pk, action_time, user_id, content_type_id, object_id,
+                       object_repr, action_flag, change_message) in rows
+                    if not (content_type_id,
+                            target.normalize_pk(object_id),
+                            action_time,
+                            action_flag) in existing]
+                target.bulk_create(entries)
+
+            last_id = rows[-1][0]
+            copied += len(entries)
+            skipped += len(rows) - len(entries)
+            self.stdout.write(
+                'Copied %s rows, skipped %s, last LogEntry id %s\n' % (
+                    copied, skipped, last_id,
+                )
+            )
+
+
+def _existing_keys(target, rows):
+    """
+    Return the keys of the target entries in the time span of rows.
+    """
+    action_times = [row[1] for row in rows]
+    values = target.model.objects.filter(
+        action_time__range=(min(action_times), max(action_times)),
+    ).values(
+        'content_type_id', 'action_time', target.action_field,
+        *target.object_fields
+    )
+    return set(
+        (v['content_type_id'], target.values_object_key(v),
+         v['action_time'], v[target.action_field])
+        for v in values
+    )
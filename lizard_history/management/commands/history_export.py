@@ -0,0 +1,138 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Export history entries to a gzip compressed JSON lines file.
+
+Entries are read in chunks of consecutive ids, so memory use does not
+depend on the number of entries. The file is appended to and the last
+exported id is reported after every chunk, so an interrupted export can
+be resumed with --start-id. References to extras blobs and api_object
+sections are replaced by their content, so the export does not depend on
+the ExtrasBlob table.
+"""
+from optparse import make_option
+import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.dateparse import parse_datetime
+
+from lizard_history import archive
+from lizard_history import utils
+from lizard_history.storage import get_storage
+
+
+def _parse_time(value):
+    """
+    Return datetime for a date or datetime string, raise CommandError.
+    """
+    result = parse_datetime(value)
+    if result is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError('Invalid date or time: %s' % value)
+        result = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ and timezone.is_naive(result):
+        result = timezone.make_aware(result, timezone.get_default_timezone())
+    return result
+
+
+class Command(BaseCommand):
+    args = '<output.jsonl.gz>'
+    help = "Export history entries to gzip compressed JSON lines."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--model',
+                    dest='models',
+                    action='append',
+                    default=[],
+                    help='Only export app_label or app_label.model, '
+                    'can be repeated'),
+        make_option('--since',
+                    dest='since',
+                    default=None,
+                    help='Only export entries from this date or time'),
+        make_option('--until',
+                    dest='until',
+                    default=None,
+                    help='Only export entries before this date or time'),
+        make_option('--user',
+                    dest='user',
+                    default=None,
+                    help='Only export entries of this username'),
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=1000,
+                    help='Number of entries per chunk'),
+        make_option('--start-id',
+                    dest='start_id',
+                    type='int',
+                    default=0,
+                    help='Only export entries with a larger id'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Supply the output file.')
+
+        entries = get_storage().entries(utils.LIZARD_ACTIONS)
+        if options['models']:
+            content_types = Q()
+            for model in options['models']:
+                if '.' in model:
+                    app_label, model_name = model.split('.', 1)
+                    model_filter = Q(app_label=app_label,
+                                     model=model_name.lower())
+                else:
+                    model_filter = Q(app_label=model)
+                if not ContentType.objects.filter(model_filter).exists():
+                    raise CommandError('Unknown model: %s' % model)
+                content_types |= model_filter
+            entries = entries.filter(content_type__in=list(
+                ContentType.objects.filter(content_types),
+            ))
+        if options['since']:
+            entries = entries.filter(
+                action_time__gte=_parse_time(options['since']),
+            )
+        if options['until']:
+            entries = entries.filter(
+                action_time__lt=_parse_time(options['until']),
+            )
+        if options['user']:
+            try:
+                entries = entries.filter(user=User.objects.get(
+                    username=options['user'],
+                ))
+            except User.DoesNotExist:
+                raise CommandError('No such user: %s' % options['user'])
+
+        output = archive.JsonLinesFile(args[0])
+        last_id = options['start_id']
+        exported = 0
+        try:
+            while True:
+                chunk = list(entries.filter(
+                    pk__gt=last_id,
+                ).order_by('pk')[:options['chunk_size']])
+                if not chunk:
+                    break
+                for log_entry in chunk:
+                    output.write(archive.entry_record(
+                        log_entry, resolve_blobs=True,
+                    ))
+                output.flush()
+
+                last_id = chunk[-1].pk
+                exported += len(chunk)
+                self.stdout.write('Exported %s entries, last id %s\n' % (
+                    exported, last_id,
+                ))
+        finally:
+            output.close()
@@ -0,0 +1,86 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Prune history entries according to LIZARD_HISTORY_RETENTION.
+
+Entries are deleted in chunks of consecutive ids, each chunk in its own
+transaction, with a pause in between to leave room for other traffic.
+With --archive-dir, the pruned entries are first appended to a gzip
+compressed JSON lines file per model. An interrupted run can simply be
+started again; entries archived but not yet deleted are archived twice.
+"""
+from optparse import make_option
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from lizard_history import archive
+from lizard_history import retention
+
+
+class Command(BaseCommand):
+    help = "Prune history entries according to the retention policies."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=1000,
+                    help='Number of entry ids per chunk'),
+        make_option('--sleep',
+                    dest='sleep',
+                    type='float',
+                    default=0.5,
+                    help='Seconds to wait after each deleting chunk'),
+        make_option('--archive-dir',
+                    dest='archive_dir',
+                    default=None,
+                    help='Directory to archive pruned entries to'),
+        make_option('--model',
+                    dest='model',
+                    default=None,
+                    help='Only prune this model, app_label.ObjectName'),
+        make_option('--dry-run',
+                    dest='dry_run',
+                    action='store_true',
+                    default=False,
+                    help='Only report what would be pruned'),
+    )
+
+    def handle(self, *args, **options):
+        policies = [policy for policy in retention.policies()
+                    if options['model'] in (None, policy.model)]
+        if not policies:
+            raise CommandError('No retention policy configured.')
+        if options['archive_dir'] and not os.path.isdir(
+            options['archive_dir']):
+            raise CommandError('No such directory: %s' %
+                               options['archive_dir'])
+
+        timestamp = timezone.now().strftime('%Y%m%d%H%M%S')
+        for policy in policies:
+            archive_file = None
+            if options['archive_dir'] and not options['dry_run']:
+                archive_file = archive.JsonLinesFile(os.path.join(
+                    options['archive_dir'],
+                    'history-%s-%s.jsonl.gz' % (policy.model, timestamp),
+                ))
+            pruner = retention.Pruner(
+                policy,
+                chunk_size=options['chunk_size'],
+                sleep=options['sleep'],
+                archive=archive_file,
+                dry_run=options['dry_run'],
+            )
+            verb = 'would prune' if options['dry_run'] else 'pruned'
+            pruned = 0
+            try:
+                for last_id, count in pruner.run():
+                    pruned += count
+                    self.stdout.write('%s: %s %s entries, last id %s\n' % (
+                        policy.model, verb, pruned, last_id,
+                    ))
+            finally:
+                if archive_file is not None:
+                    archive_file.close()
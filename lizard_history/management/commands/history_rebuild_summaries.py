@@ -0,0 +1,67 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Rebuild the HistorySummary table from the stored entries.
+
+The table is emptied with a single DELETE, after which the entries are
+read in chunks in order of their id, each chunk in its own transaction.
+Memory use depends on the chunk size only. Entries written while the
+command runs may be counted twice, so run it while history is not being
+written.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+
+from lizard_history import summaries
+from lizard_history import utils
+from lizard_history.models import HistorySummary
+from lizard_history.storage import get_storage
+
+
+class Command(BaseCommand):
+    help = "Rebuild the history summaries from the history entries."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=1000,
+                    help='Number of entries per chunk'),
+    )
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        entries = storage.entries(
+            (utils.LIZARD_ADDITION, utils.LIZARD_CHANGE),
+        ).defer(
+            storage.payload_field,
+        ).order_by('pk')
+
+        # Not through the ORM, which would load every summary to delete.
+        with transaction.commit_on_success():
+            connection.cursor().execute('DELETE FROM %s' % (
+                connection.ops.quote_name(HistorySummary._meta.db_table),
+            ))
+            transaction.set_dirty()
+
+        last_pk = 0
+        count = 0
+        while True:
+            with transaction.commit_on_success():
+                chunk = list(entries.filter(
+                    pk__gt=last_pk,
+                )[:options['chunk_size']])
+                if not chunk:
+                    break
+                summaries.update_summaries(chunk)
+
+            last_pk = chunk[-1].pk
+            count += len(chunk)
+            self.stdout.write('Processed %s entries, last id %s\n' % (
+                count, last_pk,
+            ))
+
+        self.stdout.write('Rebuilt %s summaries\n' %
+                          HistorySummary.objects.count())
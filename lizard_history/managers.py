@@ -0,0 +1,72 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Managers that record the history of set based changes.
+
+QuerySet.update() and bulk_create() do not send the signals that
+lizard_history listens to. Monitored models can use HistoryManager, or
+mix HistoryQuerySetMixin into their own QuerySet, to have these changes
+logged like saves, in one query for the pre-images and one for the
+post-images. QuerySet.delete() sends the signals itself.
+"""
+from django.db import models
+from django.db import transaction
+from django.db.models.query import QuerySet
+
+from lizard_history import handlers
+from lizard_history import utils
+from lizard_history.registry import registry
+
+
+class HistoryQuerySetMixin(object):
+    """
+    QuerySet mixin that records update() and bulk_create() in a request.
+    """
+    def _records_history(self):
+        return (bool(utils.active_request()) and
+                registry.is_monitored(self.model))
+
+    def _update(self, kwargs):
+        # The rows are locked, so that the pre-images are what is updated.
+        pre_copies = list(self._clone().select_for_update())
+        rows = super(HistoryQuerySetMixin, self).update(**kwargs)
+        handlers.record_bulk_update(pre_copies)
+        return rows
+
+    def update(self, **kwargs):
+        """
+        Update the rows, see QuerySet.update.
+
+        The pre-images are fetched in the same transaction as the update.
+        If a transaction is already being managed, that one is used.
+        """
+        if not self._records_history():
+            return super(HistoryQuerySetMixin, self).update(**kwargs)
+        if transaction.is_managed(using=self.db):
+            return self._update(kwargs)
+        with transaction.commit_on_success(using=self.db):
+            return self._update(kwargs)
+
+    def bulk_create(self, objs):
+        """
+        Create objs, see QuerySet.bulk_create.
+
+        Only objects with a pk set beforehand are recorded, since django
+        does not return the pks of the created rows.
+        """
+        objs = list(objs)
+        result = super(HistoryQuerySetMixin, self).bulk_create(objs)
+        if self._records_history():
+            handlers.record_bulk_create(objs)
+        return result
+
+
+class HistoryQuerySet(HistoryQuerySetMixin, QuerySet):
+    pass
+
+
+class HistoryManager(models.Manager):
+    """
+    Manager whose querysets record update() and bulk_create().
+    """
+    def get_query_set(self):
+        return HistoryQuerySet(self.model, using=self._db)
@@ -1,13 +1,19 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 
+import threading
+
+from django.conf import settings
+from django.core.signals import request_started
 from django.db import models
-from django.dispatch import receiver
+from django.utils.encoding import smart_unicode
 
 from django.utils.translation import ugettext_lazy as _
 
 from lizard_history import (
     handlers,
+    registry,
     signals,
+    utils,
 )
 
 import lizard_history.configchecker
@@ -32,6 +38,12 @@ EXCLUDED_MODELS = [
     User,
 ]
 
+GLOBAL_DISPATCH = 'global'
+SENDER_DISPATCH = 'sender'
+
+# In 'sender' mode the receivers are only connected to monitored models.
+DISPATCH = getattr(settings, 'LIZARD_HISTORY_DISPATCH', GLOBAL_DISPATCH)
+
 signals.ops_done.connect(handlers.process_request_handler)
 
 
@@ -42,41 +54,42 @@ def _is_monitored(sender):
     if sender in EXCLUDED_MODELS:
         return False
 
-    return MonitoredModel.objects.filter(
-        app_label=sender.__module__.split('.')[0],
-        model=sender.__name__.lower(),
-    ).exists()
+    return registry.registry.is_monitored(sender)
+
+
+def post_init_handler(sender, instance, **kwargs):
+    if _is_monitored(sender):
+        handlers.store_loaded_state(instance)
 
 
-@receiver(models.signals.pre_save)
 def pre_save_handler(sender, instance, **kwargs):
     if _is_monitored(sender):
         kwargs.update(signal_name='pre_save')
         handlers.db_handler(sender, instance, **kwargs)
 
 
-@receiver(models.signals.post_save)
 def post_save_handler(sender, instance, **kwargs):
     if _is_monitored(sender):
         kwargs.update(signal_name='post_save')
         handlers.db_handler(sender, instance, **kwargs)
+        if handlers.TRACK_LOADED_STATE:
+            handlers.store_loaded_state(instance)
 
 
-@receiver(models.signals.pre_delete)
 def pre_delete_handler(sender, instance, **kwargs):
     if _is_monitored(sender):
         kwargs.update(signal_name='pre_delete')
         handlers.db_handler(sender, instance, **kwargs)
 
 
-@receiver(models.signals.post_delete)
 def post_delete_handler(sender, instance, **kwargs):
     if _is_monitored(sender):
         kwargs.update(signal_name='post_delete')
         handlers.db_handler(sender, instance, **kwargs)
+        if handlers.TRACK_LOADED_STATE:
+            handlers.clear_loaded_state(instance)
 
 
-@receiver(models.signals.m2m_changed)
 def m2m_changed_handler(sender, instance, **kwargs):
     """
     A bit different than the four signals above, since
@@ -92,6 +105,121 @@ def m2m_changed_handler(sender, instance, **kwargs):
                             **kwargs)
 
 
+INSTANCE_RECEIVERS = (
+    (models.signals.pre_save, pre_save_handler),
+    (models.signals.post_save, post_save_handler),
+    (models.signals.pre_delete, pre_delete_handler),
+    (models.signals.post_delete, post_delete_handler),
+)
+if handlers.TRACK_LOADED_STATE:
+    INSTANCE_RECEIVERS += ((models.signals.post_init, post_init_handler),)
+
+# State of the connections in 'sender' dispatch mode, guarded by
+# _wiring_lock since requests start concurrently.
+_wiring_lock = threading.RLock()
+_wired_keys = []
+_connected_senders = set()
+_connected_through_models = set()
+
+
+def _through_models(model):
+    """
+    Return the intermediate models of m2m relations on either side of model.
+    """
+    through_models = set()
+    for field in model._meta.many_to_many:
+        through_models.add(field.rel.through)
+    for related in model._meta.get_all_related_many_to_many_objects():
+        through_models.add(related.field.rel.through)
+    return through_models
+
+
+def connect_global_receivers():
+    """
+    Connect the receivers for all senders.
+    """
+    for signal, handler in INSTANCE_RECEIVERS:
+        signal.connect(handler)
+    models.signals.m2m_changed.connect(m2m_changed_handler)
+
+
+def disconnect_receivers():
+    """
+    Disconnect the receivers in either dispatch mode.
+    """
+    with _wiring_lock:
+        for signal, handler in INSTANCE_RECEIVERS:
+            signal.disconnect(handler)
+            for sender in _connected_senders:
+                signal.disconnect(handler, sender=sender)
+        models.signals.m2m_changed.disconnect(m2m_changed_handler)
+        for through_model in _connected_through_models:
+            models.signals.m2m_changed.disconnect(
+                m2m_changed_handler, sender=through_model,
+            )
+        _connected_senders.clear()
+        _connected_through_models.clear()
+        del _wired_keys[:]
+
+
+def connect_monitored_senders(keys=None):
+    """
+    Connect the receivers to the monitored model classes only.
+
+    Senders that are no longer monitored are disconnected.
+    """
+    if keys is None:
+        keys = registry.registry.keys()
+    senders = set(
+        m for m in models.get_models()
+        if registry.model_key(m) in keys and not m in EXCLUDED_MODELS
+    )
+    through_models = set()
+    for sender in senders:
+        through_models.update(_through_models(sender))
+
+    with _wiring_lock:
+        for signal, handler in INSTANCE_RECEIVERS:
+            for sender in _connected_senders - senders:
+                signal.disconnect(handler, sender=sender)
+            for sender in senders - _connected_senders:
+                signal.connect(handler, sender=sender)
+        for through_model in _connected_through_models - through_models:
+            models.signals.m2m_changed.disconnect(
+                m2m_changed_handler, sender=through_model,
+            )
+        for through_model in through_models - _connected_through_models:
+            models.signals.m2m_changed.connect(
+                m2m_changed_handler, sender=through_model,
+            )
+
+        _connected_senders.clear()
+        _connected_senders.update(senders)
+        _connected_through_models.clear()
+        _connected_through_models.update(through_models)
+        _wired_keys[:] = [keys]
+
+
+def refresh_monitored_senders(**kwargs):
+    """
+    Rewire the senders if the monitored models changed.
+
+    Connected to the start of (fake) requests in 'sender' dispatch mode.
+    The first call does the initial wiring, since the app cache is not
+    complete yet while this module is imported.
+    """
+    keys = registry.registry.keys()
+    with _wiring_lock:
+        if not _wired_keys or _wired_keys[0] != keys:
+            connect_monitored_senders(keys)
+
+
+def monitored_model_changed_handler(sender, **kwargs):
+    registry.monitored_model_changed_handler(sender, **kwargs)
+    if DISPATCH == SENDER_DISPATCH:
+        refresh_monitored_senders()
+
+
 class MonitoredModel(models.Model):
     name = models.CharField(
         max_length=100,
@@ -114,3 +242,219 @@ class MonitoredModel(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+def split_object_pk(object_pk):
+    """
+    Return (object_id, object_key) for storing object_pk in HistoryEntry.
+
+    Integer pks, also in their text form, go into object_id. Other pks,
+    such as uuids, go into object_key.
+    """
+    if isinstance(object_pk, (int, long)):
+        return object_pk, ''
+    object_pk = smart_unicode(object_pk)
+    if object_pk.isdigit() and unicode(int(object_pk)) == object_pk:
+        return int(object_pk), ''
+    return None, object_pk
+
+
+class HistoryEntry(models.Model):
+    """
+    History entry with typed and indexed columns.
+
+    Used instead of django's LogEntry with LIZARD_HISTORY_STORAGE set to
+    'historyentry'. The composite indexes on (content_type, object_id,
+    action_time), (content_type, object_key, action_time) and (user,
+    action_time) are created by the migration.
+    """
+    action_time = models.DateTimeField(
+        verbose_name=_('Action time'),
+    )
+    user = models.ForeignKey(
+        User,
+        verbose_name=_('User'),
+    )
+    content_type = models.ForeignKey(
+        ContentType,
+        verbose_name=_('Content type'),
+    )
+    object_id = models.BigIntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_('Object id'),
+    )
+    object_key = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        verbose_name=_('Object key'),
+    )
+    object_repr = models.CharField(
+        max_length=200,
+        verbose_name=_('Object representation'),
+    )
+    action = models.PositiveSmallIntegerField(
+        verbose_name=_('Action'),
+    )
+    payload = models.TextField(
+        blank=True,
+        verbose_name=_('Payload'),
+    )
+
+    class Meta:
+        verbose_name = _('History entry')
+        verbose_name_plural = _('History entries')
+        ordering = ('-action_time',)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.object_repr, self.action_time)
+
+    @property
+    def action_flag(self):
+        return self.action
+
+    @property
+    def change_message(self):
+        return self.payload
+
+    @property
+    def object_pk(self):
+        if self.object_id is None:
+            return self.object_key
+        return self.object_id
+
+
+
+class ExtrasBlob(models.Model):
+    """
+    Custom extras JSON, stored once and referenced by its sha1 digest.
+    """
+    digest = models.CharField(
+        max_length=40,
+        primary_key=True,
+        verbose_name=_('Digest'),
+    )
+    data = models.TextField(
+        verbose_name=_('Data'),
+    )
+
+    class Meta:
+        verbose_name = _('Extras blob')
+        verbose_name_plural = _('Extras blobs')
+
+    def __unicode__(self):
+        return self.digest
+
+
+class PendingExtras(models.Model):
+    """
+    Entry whose custom extras are still to be computed.
+
+    See LIZARD_HISTORY_DEFER_EXTRAS.
+    """
+    storage = models.CharField(
+        max_length=20,
+        verbose_name=_('Storage'),
+    )
+    entry_id = models.IntegerField(
+        verbose_name=_('Entry id'),
+    )
+    created = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('Created'),
+    )
+
+    class Meta:
+        verbose_name = _('Pending extras')
+        verbose_name_plural = _('Pending extras')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.storage, self.entry_id)
+
+
+class HistorySummary(models.Model):
+    """
+    Created and modified info of an object, maintained at write time.
+
+    The primary key is built from the content type id and object pk by
+    summary_key. See LIZARD_HISTORY_SUMMARY_TABLE.
+    """
+    key = models.CharField(
+        max_length=300,
+        primary_key=True,
+        verbose_name=_('Key'),
+    )
+    content_type = models.ForeignKey(
+        ContentType,
+        verbose_name=_('Content type'),
+    )
+    object_key = models.CharField(
+        max_length=255,
+        verbose_name=_('Object key'),
+    )
+    created_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name=_('Created at'),
+    )
+    created_by = models.ForeignKey(
+        User,
+        null=True,
+        blank=True,
+        related_name='+',
+        on_delete=models.SET_NULL,
+        verbose_name=_('Created by'),
+    )
+    modified_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name=_('Modified at'),
+    )
+    modified_by = models.ForeignKey(
+        User,
+        null=True,
+        blank=True,
+        related_name='+',
+        on_delete=models.SET_NULL,
+        verbose_name=_('Modified by'),
+    )
+    change_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('Change count'),
+    )
+
+    class Meta:
+        verbose_name = _('History summary')
+        verbose_name_plural = _('History summaries')
+
+    def __unicode__(self):
+        return self.key
+
+
+def summary_key(content_type_id, object_pk):
+    return u'%s:%s' % (content_type_id, smart_unicode(object_pk))
+
+
+EXCLUDED_MODELS.append(HistoryEntry)  # Prevent a loop
+EXCLUDED_MODELS.append(ExtrasBlob)
+EXCLUDED_MODELS.append(PendingExtras)
+EXCLUDED_MODELS.append(HistorySummary)
+
+models.signals.post_save.connect(utils.invalidate_lookups, sender=User)
+models.signals.post_delete.connect(utils.invalidate_lookups, sender=User)
+
+models.signals.post_save.connect(
+    monitored_model_changed_handler,
+    sender=MonitoredModel,
+)
+models.signals.post_delete.connect(
+    monitored_model_changed_handler,
+    sender=MonitoredModel,
+)
+
+if DISPATCH == SENDER_DISPATCH:
+    request_started.connect(refresh_monitored_senders)
+    signals.fake_request_started.connect(refresh_monitored_senders)
+else:
+    connect_global_receivers()
@@ -0,0 +1,110 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Process wide registry of monitored models.
+
+The set of monitored (app_label, model) keys is loaded from the
+MonitoredModel table once and answered from memory afterwards. Saving or
+deleting a MonitoredModel invalidates the registry in this process and
+bumps a generation counter in django's cache, so that other processes
+reload their copy on their next check. Processes that do not share a
+cache reload anyway once LIZARD_HISTORY_REGISTRY_TIMEOUT has passed.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Seconds between checks of the shared generation counter.
+CHECK_INTERVAL = getattr(
+    settings, 'LIZARD_HISTORY_REGISTRY_CHECK_INTERVAL', 5,
+)
+# Maximum age in seconds of the in memory set, regardless of the cache.
+TIMEOUT = getattr(settings, 'LIZARD_HISTORY_REGISTRY_TIMEOUT', 60)
+
+GENERATION_CACHE_KEY = 'lizard_history_registry_generation'
+
+
+def model_key(model):
+    """
+    Return (app_label, model) key as stored in MonitoredModel.
+    """
+    return (model.__module__.split('.')[0], model.__name__.lower())
+
+
+class MonitoredModelRegistry(object):
+    """
+    In memory set of monitored model keys.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = None
+        self._generation = None
+        self._loaded_at = 0
+        self._checked_at = 0
+
+    def _shared_generation(self):
+        try:
+            return cache.get(GENERATION_CACHE_KEY)
+        except Exception:  # A broken cache must not break saving.
+            return None
+
+    def _load(self):
+        from lizard_history.models import MonitoredModel
+        keys = frozenset(MonitoredModel.objects.values_list(
+            'app_label', 'model',
+        ))
+        now = time.time()
+        with self._lock:
+            self._keys = keys
+            self._generation = self._shared_generation()
+            self._loaded_at = now
+            self._checked_at = now
+        return keys
+
+    def _is_stale(self):
+        if self._keys is None:
+            return True
+        now = time.time()
+        if now - self._loaded_at > TIMEOUT:
+            return True
+        if now - self._checked_at > CHECK_INTERVAL:
+            self._checked_at = now
+            return self._shared_generation() != self._generation
+        return False
+
+    def keys(self):
+        """
+        Return frozenset of monitored (app_label, model) keys.
+        """
+        if self._is_stale():
+            return self._load()
+        return self._keys
+
+    def is_monitored(self, model):
+        return model_key(model) in self.keys()
+
+    def invalidate(self, broadcast=True):
+        """
+        Drop the loaded set, and let other processes know if broadcast.
+        """
+        with self._lock:
+            self._keys = None
+        if not broadcast:
+            return
+        try:
+            cache.incr(GENERATION_CACHE_KEY)
+        except ValueError:
+            cache.set(GENERATION_CACHE_KEY, 1)
+        except Exception:
+            pass
+
+
+registry = MonitoredModelRegistry()
+
+
+def monitored_model_changed_handler(sender, **kwargs):
+    """
+    Invalidate the registry when a MonitoredModel is saved or deleted.
+    """
+    registry.invalidate()
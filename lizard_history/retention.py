@@ -0,0 +1,229 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Retention of history entries.
+
+LIZARD_HISTORY_RETENTION maps models in 'app_label.ObjectName' style to
+their retention policy, for example::
+
+    LIZARD_HISTORY_RETENTION = {
+        'lizard_wbconfiguration.Bucket': {
+            'max_age': 365,  # Days
+            'max_entries': 100,  # Per object
+        },
+    }
+
+Entries are pruned by the history_prune management command, in chunks of
+consecutive ids. The first entry of an object (its creation) and its last
+entry are kept, unless keep_first or keep_last is False. Entries are
+ordered by id, which follows their action time.
+
+The changes of pruned entries are folded into the next kept entry of the
+object, so that get_state_at still rebuilds the right state from the
+creation onwards. The state at a time within a pruned span is the state
+after the kept entry before it. With LIZARD_HISTORY_SUMMARY_TABLE, the
+summaries of the pruned objects are recomputed.
+"""
+import datetime
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import Max
+from django.db.models import Min
+from django.utils import simplejson
+from django.utils import timezone
+
+from lizard_history import archive
+from lizard_history import codec
+from lizard_history import summaries
+from lizard_history import utils
+from lizard_history.storage import get_storage
+
+RETENTION = getattr(settings, 'LIZARD_HISTORY_RETENTION', {})
+
+
+class RetentionPolicy(object):
+    """
+    Which entries of the objects of a model to keep.
+
+    Entries older than max_age days, and entries before the newest
+    max_entries of an object, are pruned.
+    """
+    def __init__(self, model, max_age=None, max_entries=None,
+                 keep_first=True, keep_last=True):
+        self.model = model
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.keep_first = keep_first
+        self.keep_last = keep_last
+
+    def content_type(self):
+        app_label, object_name = self.model.split('.')
+        return ContentType.objects.get_by_natural_key(
+            app_label, object_name.lower(),
+        )
+
+
+def policies():
+    """
+    Return the configured retention policies.
+    """
+    return [RetentionPolicy(model, **declaration)
+            for model, declaration in sorted(RETENTION.items())]
+
+
+class Pruner(object):
+    """
+    Prune the entries of policy, chunk_size ids at a time.
+
+    Every chunk is deleted in its own transaction, after which the pruner
+    sleeps for sleep seconds. If an archive is given, see
+    archive.JsonLinesFile, the entries are written to it before they are
+    deleted. With dry_run, nothing is written or deleted.
+    """
+    def __init__(self, policy, chunk_size=1000, sleep=0, archive=None,
+                 dry_run=False):
+        self.policy = policy
+        self.chunk_size = chunk_size
+        self.sleep = sleep
+        self.archive = archive
+        self.dry_run = dry_run
+        self.storage = get_storage()
+        self.entries = self.storage.entries(utils.LIZARD_ACTIONS).filter(
+            content_type=policy.content_type(),
+        )
+
+    def _objects_info(self, object_keys):
+        """
+        Return dict of object key to (first id, last id, first id to keep).
+        """
+        storage = self.storage
+        max_entries = self.policy.max_entries
+        rows = self.entries.filter(
+            **storage.objects_filter(object_keys)
+        ).order_by().values(
+            *storage.object_fields
+        ).annotate(
+            first=Min('pk'), last=Max('pk'), count=Count('pk'),
+        )
+
+        result = {}
+        for row in rows:
+            object_key = storage.values_object_key(row)
+            keep_from = None
+            if max_entries and row['count'] > max_entries:
+                keep_from = self.entries.filter(
+                    **storage.object_filter(object_key)
+                ).order_by('-pk').values_list(
+                    'pk', flat=True,
+                )[max_entries - 1]
+            result[object_key] = (row['first'], row['last'], keep_from)
+        return result
+
+    def _prunable_pks(self, rows):
+        policy = self.policy
+        cutoff = None
+        if policy.max_age is not None:
+            cutoff = timezone.now() - datetime.timedelta(days=policy.max_age)
+
+        objects_info = self._objects_info(set(
+            self.storage.values_object_key(row) for row in rows
+        ))
+        pks = []
+        for row in rows:
+            first, last, keep_from = objects_info[
+                self.storage.values_object_key(row)
+            ]
+            if policy.keep_first and row['pk'] == first:
+                continue
+            if policy.keep_last and row['pk'] == last:
+                continue
+            if ((cutoff is not None and row['action_time'] < cutoff) or
+                (keep_from is not None and row['pk'] < keep_from)):
+                pks.append(row['pk'])
+        return pks
+
+    def _fold(self, pruned_entries):
+        """
+        Fold the changes of pruned_entries into the next kept entries.
+
+        The pruned_entries are those of one object, in order of id.
+        """
+        storage = self.storage
+        object_key = storage.object_key(pruned_entries[0])
+        next_entries = self.entries.filter(
+            pk__gt=pruned_entries[-1].pk,
+            **storage.object_filter(object_key)
+        ).order_by('pk')[:1]
+        if not next_entries or (
+            next_entries[0].action_flag == utils.LIZARD_DELETION):
+            return  # Nothing to rebuild a state for.
+        kept_entry = next_entries[0]
+
+        changes = {}
+        for log_entry in pruned_entries + [kept_entry]:
+            data = simplejson.loads(codec.decode(log_entry.change_message))
+            for attname, change in data['changes'].items():
+                if attname in changes:
+                    changes[attname]['new'] = change['new']
+                else:
+                    changes[attname] = dict(change)
+        # The other keys, such as the extras, remain those of kept_entry.
+        data['changes'] = dict((k, v) for k, v in changes.items()
+                               if v['old'] != v['new'])
+        storage.model.objects.filter(pk=kept_entry.pk).update(**{
+            storage.payload_field: codec.encode(simplejson.dumps(
+                data,
+                cls=DateTimeAwareJSONEncoder,
+            )),
+        })
+
+    def _delete(self, pks):
+        storage = self.storage
+        pruned_entries = list(storage.model.objects.filter(
+            pk__in=pks,
+        ).order_by('pk'))
+        if self.archive is not None:
+            for log_entry in pruned_entries:
+                self.archive.write(archive.entry_record(log_entry))
+            self.archive.flush()
+
+        entries_per_object = {}
+        for log_entry in pruned_entries:
+            entries_per_object.setdefault(
+                storage.object_key(log_entry), [],
+            ).append(log_entry)
+        for object_entries in entries_per_object.values():
+            self._fold(object_entries)
+
+        storage.model.objects.filter(pk__in=pks).delete()
+
+        if summaries.SUMMARY_TABLE:
+            content_type_id = self.policy.content_type().pk
+            for object_key in entries_per_object:
+                summaries.refresh_summary(content_type_id, object_key)
+
+    def run(self):
+        """
+        Iterate over (last id, number of pruned entries) per chunk.
+        """
+        last_pk = 0
+        while True:
+            rows = list(self.entries.filter(
+                pk__gt=last_pk,
+            ).order_by('pk').values(
+                'pk', 'action_time', *self.storage.object_fields
+            )[:self.chunk_size])
+            if not rows:
+                break
+            last_pk = rows[-1]['pk']
+
+            pks = self._prunable_pks(rows)
+            if pks and not self.dry_run:
+                with transaction.commit_on_success():
+                    self._delete(pks)
+                time.sleep(self.sleep)
+            yield last_pk, len(pks)
@@ -3,3 +3,4 @@
 from django.dispatch import Signal
 
 ops_done = Signal()
+fake_request_started = Signal()
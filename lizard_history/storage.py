@@ -0,0 +1,172 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Storage backends for history entries.
+
+LIZARD_HISTORY_STORAGE selects where history is written and read:
+'logentry' (default) uses django's admin LogEntry, 'historyentry' uses
+lizard_history's own indexed HistoryEntry table. Entries of both
+backends offer action_flag and change_message attributes.
+"""
+from django.conf import settings
+from django.utils.encoding import smart_unicode
+
+from django.contrib.admin.models import LogEntry
+
+LOGENTRY_STORAGE = 'logentry'
+HISTORYENTRY_STORAGE = 'historyentry'
+
+STORAGE = getattr(settings, 'LIZARD_HISTORY_STORAGE', LOGENTRY_STORAGE)
+
+
+class LogEntryStorage(object):
+    """
+    Store history in django's admin log, with text object ids.
+    """
+    action_field = 'action_flag'
+    payload_field = 'change_message'
+    object_fields = ('object_id',)
+
+    @property
+    def model(self):
+        return LogEntry
+
+    def entries(self, action_flags):
+        """
+        Return queryset of entries with one of action_flags.
+        """
+        return self.model.objects.filter(
+            **{self.action_field + '__in': action_flags}
+        )
+
+    def object_filter(self, object_pk):
+        """
+        Return filter kwargs for entries about the object with object_pk.
+        """
+        return {'object_id': smart_unicode(object_pk)}
+
+    def objects_filter(self, object_pks):
+        """
+        Return filter kwargs for entries about any of object_pks.
+        """
+        return {'object_id__in': [smart_unicode(pk) for pk in object_pks]}
+
+    def object_key(self, entry):
+        """
+        Return the object pk of entry, in the form of normalize_pk.
+        """
+        return entry.object_id
+
+    def values_object_key(self, values):
+        """
+        Return the object pk in a values() row of object_fields.
+        """
+        return values['object_id']
+
+    def normalize_pk(self, object_pk):
+        """
+        Return object_pk in the form it is stored in.
+        """
+        return smart_unicode(object_pk)
+
+    def build(self, action_time, user_id, content_type_id, object_pk,
+              object_repr, action_flag, change_message):
+        """
+        Return an unsaved entry.
+        """
+        return LogEntry(
+            action_time=action_time,
+            user_id=user_id,
+            content_type_id=content_type_id,
+            object_id=smart_unicode(object_pk),
+            object_repr=object_repr[:200],
+            action_flag=action_flag,
+            change_message=change_message,
+        )
+
+    def bulk_create(self, entries):
+        """
+        Insert entries. LogEntry.action_time has auto_now, so the entries
+        get the time of the insert, see LIZARD_HISTORY_ASYNC.
+        """
+        self.model.objects.bulk_create(entries)
+
+
+class HistoryEntryStorage(LogEntryStorage):
+    """
+    Store history in the HistoryEntry table, with typed object keys.
+    """
+    action_field = 'action'
+    payload_field = 'payload'
+    object_fields = ('object_id', 'object_key')
+
+    @property
+    def model(self):
+        from lizard_history.models import HistoryEntry
+        return HistoryEntry
+
+    def object_filter(self, object_pk):
+        from lizard_history.models import split_object_pk
+        object_id, object_key = split_object_pk(object_pk)
+        if object_id is None:
+            return {'object_key': object_key}
+        return {'object_id': object_id}
+
+    def objects_filter(self, object_pks):
+        from lizard_history.models import split_object_pk
+        object_ids = []
+        object_keys = []
+        for object_pk in object_pks:
+            object_id, object_key = split_object_pk(object_pk)
+            if object_id is None:
+                object_keys.append(object_key)
+            else:
+                object_ids.append(object_id)
+        if object_keys and object_ids:
+            raise ValueError('Mixed integer and other object pks')
+        if object_keys:
+            return {'object_key__in': object_keys}
+        return {'object_id__in': object_ids}
+
+    def object_key(self, entry):
+        return entry.object_pk
+
+    def values_object_key(self, values):
+        if values['object_id'] is None:
+            return values['object_key']
+        return values['object_id']
+
+    def normalize_pk(self, object_pk):
+        from lizard_history.models import split_object_pk
+        object_id, object_key = split_object_pk(object_pk)
+        if object_id is None:
+            return object_key
+        return object_id
+
+    def build(self, action_time, user_id, content_type_id, object_pk,
+              object_repr, action_flag, change_message):
+        from lizard_history.models import HistoryEntry
+        from lizard_history.models import split_object_pk
+        object_id, object_key = split_object_pk(object_pk)
+        return HistoryEntry(
+            action_time=action_time,
+            user_id=user_id,
+            content_type_id=content_type_id,
+            object_id=object_id,
+            object_key=object_key,
+            object_repr=object_repr[:200],
+            action=action_flag,
+            payload=change_message,
+        )
+
+
+_storages = {
+    LOGENTRY_STORAGE: LogEntryStorage(),
+    HISTORYENTRY_STORAGE: HistoryEntryStorage(),
+}
+
+
+def get_storage(name=None):
+    """
+    Return storage backend by name, default the configured one.
+    """
+    return _storages[name or STORAGE]
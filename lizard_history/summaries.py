@@ -0,0 +1,212 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Maintenance of the HistorySummary table.
+
+With LIZARD_HISTORY_SUMMARY_TABLE = True, the created and modified info
+of each object is updated whenever entries are written, so that
+get_simple_history is a single primary key lookup. Run the
+history_rebuild_summaries management command after enabling it.
+"""
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+
+from lizard_history import utils
+from lizard_history.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_TABLE = getattr(settings, 'LIZARD_HISTORY_SUMMARY_TABLE', False)
+
+
+def apply_entry(summary, entry, merged=False):
+    """
+    Update summary with entry, which must not be older than earlier ones.
+
+    A merged entry, see coalesce, was counted already.
+    """
+    if entry.action_flag == utils.LIZARD_ADDITION:
+        summary.created_at = entry.action_time
+        summary.created_by_id = entry.user_id
+    elif entry.action_flag == utils.LIZARD_CHANGE:
+        summary.modified_at = entry.action_time
+        summary.modified_by_id = entry.user_id
+        if not merged:
+            summary.change_count += 1
+
+
+def new_summary(key, entry):
+    from lizard_history.models import HistorySummary
+    return HistorySummary(
+        key=key,
+        content_type_id=entry.content_type_id,
+        object_key=unicode(get_storage().object_key(entry)),
+    )
+
+
+def _update_summary(key, key_entries, merged):
+    """
+    Update the stored summary of key with key_entries, in place.
+
+    The change count is incremented and the created and modified info
+    only replaced by newer info, so concurrent writers do not undo each
+    other.
+    """
+    from lizard_history.models import HistorySummary
+    summary = HistorySummary(change_count=0)
+    for entry in key_entries:
+        apply_entry(summary, entry, merged=id(entry) in merged)
+
+    summaries = HistorySummary.objects.filter(pk=key)
+    if summary.change_count:
+        summaries.update(change_count=F('change_count') + summary.change_count)
+    if summary.created_at is not None:
+        summaries.filter(
+            Q(created_at__isnull=True) | Q(created_at__lte=summary.created_at)
+        ).update(
+            created_at=summary.created_at,
+            created_by=summary.created_by_id,
+        )
+    if summary.modified_at is not None:
+        summaries.filter(
+            Q(modified_at__isnull=True) |
+            Q(modified_at__lte=summary.modified_at)
+        ).update(
+            modified_at=summary.modified_at,
+            modified_by=summary.modified_by_id,
+        )
+
+
+def update_summaries(entries, merged_entries=()):
+    """
+    Update the summaries of the objects of new entries and merged entries.
+
+    Existing summaries are updated in place, see _update_summary. New
+    summaries are inserted, or updated if another writer inserted them
+    meanwhile. A failure is logged instead of raised, since the summaries
+    can be rebuilt but the entries must be written.
+    """
+    from lizard_history.models import HistorySummary
+    from lizard_history.models import summary_key
+    storage = get_storage()
+
+    merged = set(id(entry) for entry in merged_entries)
+    entries_per_key = {}
+    for entry in sorted(list(entries) + list(merged_entries),
+                        key=lambda e: e.action_time):
+        key = summary_key(entry.content_type_id, storage.object_key(entry))
+        entries_per_key.setdefault(key, []).append(entry)
+    if not entries_per_key:
+        return
+
+    existing = set(HistorySummary.objects.filter(
+        pk__in=entries_per_key.keys(),
+    ).values_list('pk', flat=True))
+    new_summaries = []
+    for key, key_entries in entries_per_key.items():
+        if key in existing:
+            _update_summary(key, key_entries, merged)
+            continue
+        summary = new_summary(key, key_entries[0])
+        for entry in key_entries:
+            apply_entry(summary, entry, merged=id(entry) in merged)
+        new_summaries.append(summary)
+    if not new_summaries:
+        return
+
+    sid = transaction.savepoint()
+    try:
+        HistorySummary.objects.bulk_create(new_summaries)
+    except IntegrityError:  # Concurrently created summary
+        transaction.savepoint_rollback(sid)
+    else:
+        transaction.savepoint_commit(sid)
+        return
+
+    sid = transaction.savepoint()
+    try:
+        for summary in new_summaries:
+            if HistorySummary.objects.filter(pk=summary.key).exists():
+                _update_summary(summary.key, entries_per_key[summary.key],
+                                merged)
+            else:
+                summary.save(force_insert=True)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        logger.warning('Could not update history summaries of %s, run '
+                       'history_rebuild_summaries.',
+                       [summary.key for summary in new_summaries])
+    else:
+        transaction.savepoint_commit(sid)
+
+
+def refresh_summary(content_type_id, object_key):
+    """
+    Recompute the stored summary of an object from its entries.
+
+    Used after entries of the object were deleted.
+    """
+    from lizard_history.models import HistorySummary
+    from lizard_history.models import summary_key
+    storage = get_storage()
+
+    def object_entries(action_flag):
+        return storage.entries((action_flag,)).filter(
+            content_type=content_type_id,
+            **storage.object_filter(object_key)
+        )
+
+    fields = {}
+    for prefix, action_flag in (('created', utils.LIZARD_ADDITION),
+                                ('modified', utils.LIZARD_CHANGE)):
+        latest = object_entries(action_flag).order_by(
+            '-action_time', '-pk',
+        ).values_list('action_time', 'user')[:1]
+        fields[prefix + '_at'], fields[prefix + '_by'] = (
+            latest[0] if latest else (None, None))
+    fields['change_count'] = object_entries(utils.LIZARD_CHANGE).count()
+    HistorySummary.objects.filter(
+        pk=summary_key(content_type_id, object_key),
+    ).update(**fields)
+
+
+def simple_history_from_summary(summary):
+    """
+    Return the get_simple_history dict for summary, which may be None.
+    """
+    simple_history = {
+        'datetime_created': None,
+        'created_by': None,
+        'datetime_modified': None,
+        'modified_by': None,
+    }
+    if summary is None:
+        return simple_history
+    if summary.created_by is not None:
+        simple_history['created_by'] = (
+            summary.created_by.get_full_name() or summary.created_by)
+        simple_history['datetime_created'] = summary.created_at
+    if summary.modified_by is not None:
+        simple_history['modified_by'] = (
+            summary.modified_by.get_full_name() or summary.modified_by)
+        simple_history['datetime_modified'] = summary.modified_at
+    return simple_history
+
+
+def simple_history_many(objs):
+    """
+    Return dict of objs to their simple history, in one query.
+    """
+    from lizard_history.models import HistorySummary
+    from lizard_history.models import summary_key
+    keys = dict((obj, summary_key(utils.get_contenttype_id(obj), obj.pk))
+                for obj in objs if obj is not None)
+    summaries = HistorySummary.objects.select_related(
+        'created_by', 'modified_by',
+    ).in_bulk(keys.values())
+    return dict((obj, simple_history_from_summary(summaries.get(key)))
+                for obj, key in keys.items())
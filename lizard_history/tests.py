@@ -1,9 +1,859 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+from StringIO import StringIO
 
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db import transaction
+from django.db.models import signals as model_signals
+from django.dispatch.dispatcher import _make_id
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.utils import simplejson
+from django.utils import timezone
+
+from lizard_history import backfill
+from lizard_history import blobs
+from lizard_history import checkpoints
+from lizard_history import codec
+from lizard_history import coalesce
+from lizard_history import groups
+from lizard_history import handlers
+from lizard_history import instrumentation
+from lizard_history import managers
+from lizard_history import models as history_models
+from lizard_history import retention
+from lizard_history import summaries
+from lizard_history.models import MonitoredModel
+from lizard_history.registry import registry
+from lizard_history.storage import get_storage
+from lizard_history import utils
+from lizard_history import views
+from lizard_history import writer
+from lizard_history.management.commands import history_export
+
+
+class GroupApiView(object):
+    """
+    HISTORY_DATA_VIEW for groups in the deferred extras test.
+    """
+    def get_object_for_api(self, obj, include_geom=False, flat=True):
+        return {'name': obj.name}
 
 
 class ExampleTest(TestCase):
 
     def test_something(self):
         self.assertEquals(1, 1)
+
+
+class RegistryTest(TestCase):
+
+    def setUp(self):
+        registry.invalidate()
+
+    def test_invalidated_on_save_and_delete(self):
+        self.assertFalse(registry.is_monitored(MonitoredModel))
+        monitored_model = MonitoredModel.objects.create(
+            name='Monitored model',
+            app_label='lizard_history',
+            model='monitoredmodel',
+        )
+        self.assertTrue(registry.is_monitored(MonitoredModel))
+        monitored_model.delete()
+        self.assertFalse(registry.is_monitored(MonitoredModel))
+
+    def test_lookups_are_answered_from_memory(self):
+        registry.keys()
+        self.assertNumQueries(0, registry.is_monitored, MonitoredModel)
+
+
+class SenderDispatchTest(TestCase):
+
+    def setUp(self):
+        history_models.disconnect_receivers()
+        MonitoredModel.objects.create(
+            name='Group', app_label='django', model='group',
+        )
+        registry.invalidate()
+
+    def tearDown(self):
+        history_models.disconnect_receivers()
+        if history_models.DISPATCH == history_models.SENDER_DISPATCH:
+            history_models.refresh_monitored_senders()
+        else:
+            history_models.connect_global_receivers()
+
+    def test_only_monitored_senders_are_connected(self):
+        history_models.refresh_monitored_senders()
+        self.assertTrue(model_signals.post_save._live_receivers(
+            _make_id(Group),
+        ))
+        self.assertEquals(history_models._connected_senders, set([Group]))
+
+        MonitoredModel.objects.all().delete()
+        registry.invalidate()
+        history_models.refresh_monitored_senders()
+        self.assertEquals(history_models._connected_senders, set())
+
+    def test_concurrent_refresh(self):
+        registry.keys()  # The threads do not see the test transaction.
+        threads = [threading.Thread(
+            target=history_models.refresh_monitored_senders,
+        ) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(history_models._connected_senders, set([Group]))
+        self.assertEquals(len(history_models._wired_keys), 1)
+
+
+class LoadedStateTest(TestCase):
+
+    def setUp(self):
+        MonitoredModel.objects.create(
+            name='Old name',
+            app_label='lizard_history',
+            model='monitoredmodel',
+        )
+        self.instance = MonitoredModel.objects.get()
+        handlers.store_loaded_state(self.instance)
+
+    def test_loaded_copy_without_query(self):
+        self.instance.name = 'New name'
+        with self.assertNumQueries(0):
+            loaded_copy = handlers._get_loaded_copy(self.instance)
+        self.assertEquals(loaded_copy.name, 'Old name')
+        self.assertEquals(loaded_copy.pk, self.instance.pk)
+
+    def test_no_loaded_copy_for_new_instance(self):
+        instance = MonitoredModel(pk=self.instance.pk, name='Other name')
+        handlers.store_loaded_state(instance)
+        self.assertEquals(handlers._get_loaded_copy(instance), None)
+
+
+class AsyncHistoryWriterTest(TestCase):
+
+    def setUp(self):
+        self.processed = []
+
+    def test_records_are_processed(self):
+        history_writer = writer.AsyncHistoryWriter(self.processed.extend)
+        history_writer.start()
+        history_writer.submit({'changes': []})
+        history_writer.submit({'changes': []})
+        history_writer.stop()
+        self.assertEquals(len(self.processed), 2)
+        self.assertEquals(history_writer.stats()['written'], 2)
+        self.assertEquals(history_writer.stats()['queue_depth'], 0)
+
+    def test_full_queue_drop(self):
+        history_writer = writer.AsyncHistoryWriter(
+            self.processed.extend, queue_size=1, full_policy=writer.DROP,
+        )
+        history_writer.submit({'changes': []})
+        history_writer.submit({'changes': []})
+        self.assertEquals(history_writer.stats()['dropped'], 1)
+        self.assertEquals(self.processed, [])
+
+    def test_full_queue_inline(self):
+        history_writer = writer.AsyncHistoryWriter(
+            self.processed.extend, queue_size=1, full_policy=writer.INLINE,
+        )
+        history_writer.submit({'changes': []})
+        history_writer.submit({'changes': []})
+        self.assertEquals(history_writer.stats()['inline'], 1)
+        self.assertEquals(len(self.processed), 1)
+
+    def test_stop_with_full_queue(self):
+        release = threading.Event()
+        history_writer = writer.AsyncHistoryWriter(
+            lambda records: release.wait(), queue_size=1,
+        )
+        history_writer.start()
+        history_writer.submit({'changes': []})
+        time.sleep(0.1)  # The worker takes the first and blocks on it.
+        history_writer.submit({'changes': []})
+        history_writer.stop(timeout=0.1)  # Must not block.
+        self.assertEquals(len(history_writer.threads), 1)
+        release.set()
+
+    def test_compact_record(self):
+        user = User(pk=3, username='user')
+        obj = MonitoredModel(pk=1, name='name', app_label='app', model='m')
+        obj._some_cache = object()
+        record = {
+            handlers.USER_ID_KEY: 3,
+            handlers.USER_KEY: user,
+            handlers.ACTION_TIME_KEY: timezone.now(),
+            handlers.CHANGES_KEY: [{
+                handlers.PRE_COPY_KEY: None,
+                handlers.POST_COPY_KEY: obj,
+            }],
+        }
+        compact = handlers.compact_record(record)
+        self.assertEquals(compact[handlers.USER_KEY], 3)
+        model, db, values = compact[handlers.CHANGES_KEY][0][
+            handlers.POST_COPY_KEY]
+        self.assertEquals(model, MonitoredModel)
+        self.assertFalse('_some_cache' in values)
+        self.assertEquals(values['name'], 'name')
+        # The original record is left alone.
+        self.assertTrue(record[handlers.CHANGES_KEY][0][
+            handlers.POST_COPY_KEY] is obj)
+
+
+class ModelDiffTest(TestCase):
+
+    def setUp(self):
+        self.old = MonitoredModel(
+            pk=1, name='Old name', app_label='app', model='model',
+        )
+        self.new = MonitoredModel(
+            pk=1, name='New name', app_label='app', model='model',
+        )
+
+    def test_changed_fields_only(self):
+        self.assertEquals(
+            utils._model_diff(self.old, self.new),
+            {'name': {'old': u'Old name', 'new': u'New name'}},
+        )
+
+    def test_addition(self):
+        diff = utils._model_diff(None, self.new)
+        self.assertEquals(diff['id'], {'old': None, 'new': u'1'})
+        self.assertEquals(len(diff), 4)
+
+    def test_same_unicode_is_no_change(self):
+        self.new.name = 'Old name'
+        self.new.id = '1'
+        self.assertEquals(utils._model_diff(self.old, self.new), {})
+
+
+class CodecTest(TestCase):
+
+    def test_compressed_round_trip(self):
+        message = u'{"changes": {"name": {"old": "\u00e9", "new": "e"}}}'
+        stored = codec.compress(message)
+        self.assertTrue(codec.is_encoded(stored))
+        self.assertEquals(codec.decode(stored), message)
+
+    def test_plain_message_is_decoded_as_is(self):
+        message = '{"changes": {}}'
+        self.assertEquals(codec.decode(message), message)
+
+    def test_compression_threshold(self):
+        compress = codec.COMPRESS
+        codec.COMPRESS = True
+        try:
+            short_message = '{"changes": {}}'
+            self.assertEquals(codec.encode(short_message, threshold=100),
+                              short_message)
+            long_message = '{"changes": {"name": "%s"}}' % ('x' * 100)
+            stored = codec.encode(long_message, threshold=100)
+            self.assertTrue(codec.is_encoded(stored))
+            self.assertEquals(codec.decode(stored), long_message)
+        finally:
+            codec.COMPRESS = compress
+
+
+class ExtrasBlobTest(TestCase):
+
+    def setUp(self):
+        blobs.blob_cache.clear()
+
+    def test_identical_extras_are_stored_once(self):
+        extras = {'tree': {'name': 'area', 'children': [1, 2]}}
+        digests = blobs.store_extras(extras)
+        self.assertEquals(digests, blobs.store_extras(extras))
+
+        blobs.blob_cache.clear()
+        data = {blobs.EXTRAS_BLOBS_KEY: digests, 'changes': {}}
+        self.assertEquals(blobs.resolve_extras(data), {
+            'changes': {},
+            'tree': {'name': 'area', 'children': [1, 2]},
+        })
+
+    def test_split_sections(self):
+        api_object = {'success': True, 'data': {'grid': [1], 'other': [2]}}
+        extras, sections = blobs.split_sections({'api_object': api_object})
+        self.assertEquals(extras, {'api_object': {'success': True}})
+        self.assertEquals(
+            blobs.resolve_blob(sections[blobs.SECTIONS_KEY]['grid']), [1],
+        )
+        extras.update(sections)
+        self.assertEquals(blobs.resolve_extras(extras)['api_object'],
+                          api_object)
+
+
+class ExtrasBlobRollbackTest(TransactionTestCase):
+
+    def setUp(self):
+        blobs.blob_cache.clear()
+
+    def _store_and_roll_back(self, store, value):
+        try:
+            with transaction.commit_on_success():
+                result = store(value)
+                raise RuntimeError('Roll back')
+        except RuntimeError:
+            pass
+        return result
+
+    def test_extras_after_rollback(self):
+        extras = {'tree': {'name': 'area', 'children': [1, 2]}}
+        digests = self._store_and_roll_back(blobs.store_extras, extras)
+        self.assertEquals(blobs.store_extras(extras), digests)
+        blobs.blob_cache.clear()
+        self.assertEquals(blobs.resolve_blob(digests['tree']),
+                          extras['tree'])
+
+    def test_sections_after_rollback(self):
+        api_object = {'success': True, 'data': {'grid': [1], 'other': [2]}}
+        extras, sections = self._store_and_roll_back(
+            blobs.split_sections, {'api_object': api_object},
+        )
+        self.assertEquals(
+            blobs.split_sections({'api_object': api_object}),
+            (extras, sections),
+        )
+        blobs.blob_cache.clear()
+        extras.update(sections)
+        self.assertEquals(blobs.resolve_extras(extras)['api_object'],
+                          api_object)
+
+
+class InstrumentationTest(TestCase):
+
+    def test_percentiles(self):
+        stats = instrumentation.Stats(max_samples=100)
+        for i in range(200):
+            stats.add('write.ms', i)
+        summary = stats.summary()['write.ms']
+        self.assertEquals(summary['count'], 100)
+        self.assertEquals(summary['p50'], 149)
+        self.assertEquals(summary['max'], 199)
+
+    def test_recorded_queries_are_kept(self):
+        instrument = instrumentation.INSTRUMENT
+        instrumentation.INSTRUMENT = True
+        try:
+            count_groups = instrumentation.instrumented('test')(
+                lambda: Group.objects.count(),
+            )
+        finally:
+            instrumentation.INSTRUMENT = instrument
+
+        use_debug_cursor = connection.use_debug_cursor
+        try:
+            connection.use_debug_cursor = True
+            start_queries = len(connection.queries)
+            count_groups()
+            self.assertEquals(len(connection.queries), start_queries + 1)
+            connection.use_debug_cursor = False
+            count_groups()
+            self.assertEquals(len(connection.queries), start_queries + 1)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+
+
+class HistoryGroupTest(TestCase):
+
+    def test_key_and_rank(self):
+        group = groups.HistoryGroup(
+            'test',
+            ('auth.User', 'lizard_history.MonitoredModel'),
+            'app_label',
+        )
+        monitored_model = MonitoredModel(app_label='lizard_area')
+        self.assertEquals(group.key(monitored_model), 'lizard_area')
+        self.assertEquals(group.rank(monitored_model), 1)
+
+    def test_default_groups(self):
+        self.assertEquals(groups.group_for_object(MonitoredModel()), None)
+
+
+class LookupCacheTest(TestCase):
+
+    def setUp(self):
+        User.objects.create(username='admin', is_superuser=True)
+        # Models are keyed by the top level package of their module.
+        MonitoredModel.objects.create(
+            name='Group', app_label='django', model='group',
+        )
+        registry.invalidate()
+        utils.invalidate_lookups()
+        ContentType.objects.clear_cache()
+
+    def _lookup_queries(self, number_of_objects):
+        """
+        Return number of user and content type queries for a session.
+        """
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            utils.start_fake_request()
+            for i in range(number_of_objects):
+                Group.objects.create(name='group %s %s' % (
+                    number_of_objects, i,
+                ))
+            utils.end_fake_request()
+            queries = connection.queries[start:]
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        return len([q for q in queries
+                    if '"auth_user"' in q['sql'] or
+                    '"django_content_type"' in q['sql']])
+
+    def test_constant_number_of_lookups(self):
+        self.assertEquals(self._lookup_queries(1000), 2)
+        self.assertEquals(
+            Group.objects.count(),
+            len(get_storage().entries(utils.LIZARD_ACTIONS)),
+        )
+        self.assertEquals(self._lookup_queries(10), 0)
+
+    def test_invalidated_on_user_save(self):
+        utils.fallback_user_pk()
+        superuser = User.objects.create(username='root', is_superuser=True)
+        User.objects.filter(username='admin').delete()
+        self.assertEquals(utils.fallback_user_pk(), superuser.pk)
+
+    def test_invalidated_by_other_process(self):
+        keys = registry.keys()
+        superuser = User.objects.create(username='root', is_superuser=True)
+        self.assertNotEquals(utils.fallback_user_pk(), superuser.pk)
+        # The monitored models are left alone.
+        self.assertTrue(registry.keys() is keys)
+        # Another process changes the users and bumps the generation.
+        User.objects.filter(username='admin').update(is_superuser=False)
+        cache.set(utils.SUPERUSER_GENERATION_CACHE_KEY, 'other')
+        utils._lookups[utils.CHECKED_AT_KEY] = 0  # The check is due.
+        self.assertEquals(utils.fallback_user_pk(), superuser.pk)
+
+
+class HistoryReadTest(TestCase):
+
+    def setUp(self):
+        User.objects.create(username='admin', is_superuser=True)
+        MonitoredModel.objects.create(
+            name='Group', app_label='django', model='group',
+        )
+        registry.invalidate()
+        utils.start_fake_request()
+        self.groups = [Group.objects.create(name='group %s' % i)
+                       for i in range(3)]
+        utils.end_fake_request()
+        utils.start_fake_request()
+        self.groups[0].name = 'changed'
+        self.groups[0].save()
+        utils.end_fake_request()
+        ContentType.objects.get_for_model(Group)  # Fill django's cache.
+
+    def test_get_history_many(self):
+        with self.assertNumQueries(1):
+            histories = utils.get_history_many(self.groups)
+        self.assertEquals(len(histories[self.groups[0]]), 2)
+        self.assertEquals(len(histories[self.groups[1]]), 1)
+        self.assertEquals(histories[self.groups[0]][0]['user'], 'admin')
+
+    def test_iter_history_pages(self):
+        first_page = list(utils.iter_history(self.groups[0], limit=1))
+        self.assertEquals(len(first_page), 1)
+        self.assertFalse('summary' in first_page[0])
+        rest = list(utils.iter_history(
+            self.groups[0], after=first_page[0]['cursor'], include_data=True,
+        ))
+        self.assertEquals(
+            [first_page[0]['log_entry_id'], rest[0]['log_entry_id']],
+            [h['log_entry_id'] for h in utils.get_history(obj=self.groups[0])],
+        )
+        self.assertTrue('changes' in rest[0])
+
+    def test_get_simple_history_many(self):
+        histories = utils.get_simple_history_many(self.groups)
+        self.assertEquals(histories[self.groups[0]],
+                          utils.get_simple_history(self.groups[0]))
+        self.assertEquals(histories[self.groups[1]]['modified_by'], None)
+
+    def test_get_state_at(self):
+        storage = get_storage()
+        created = storage.entries((utils.LIZARD_ADDITION,)).filter(
+            **storage.object_filter(self.groups[0].pk)
+        )[0].action_time
+        self.assertEquals(
+            utils.get_state_at(self.groups[0], created)['name'], 'group 0',
+        )
+        self.assertEquals(utils.get_state_at(
+            self.groups[0], created - datetime.timedelta(seconds=1),
+        ), None)
+
+        interval = checkpoints.CHECKPOINT_INTERVAL
+        checkpoints.CHECKPOINT_INTERVAL = 1
+        try:
+            utils.start_fake_request()
+            self.groups[0].name = 'checkpoint'
+            self.groups[0].save()
+            utils.end_fake_request()
+        finally:
+            checkpoints.CHECKPOINT_INTERVAL = interval
+        state = utils.get_state_at(self.groups[0], timezone.now())
+        self.assertEquals(state['name'], 'checkpoint')
+        self.assertEquals(state['id'], unicode(self.groups[0].pk))
+
+    def test_archived_history_cached(self):
+        views.archive_cache.clear()
+        log_entry_id = utils.get_history(
+            obj=self.groups[0],
+        )[0]['log_entry_id']
+        history = views.archived_history(log_entry_id)
+        with self.assertNumQueries(0):
+            cached_history = views.archived_history(log_entry_id)
+        self.assertEquals(cached_history, history)
+        self.assertEquals(views.archive_cache.stats()['hits'], 1)
+
+    def test_prune_max_entries(self):
+        for name in ('second change', 'third change'):
+            utils.start_fake_request()
+            self.groups[0].name = name
+            self.groups[0].save()
+            utils.end_fake_request()
+        before = [h['log_entry_id']
+                  for h in utils.get_history(obj=self.groups[0])]
+        self.assertEquals(len(before), 4)
+
+        policy = retention.RetentionPolicy('auth.Group', max_entries=2)
+        self.assertEquals(
+            [count for last_id, count in retention.Pruner(policy).run()],
+            [1],
+        )
+        after = [h['log_entry_id']
+                 for h in utils.get_history(obj=self.groups[0])]
+        self.assertEquals(sorted(after),
+                          sorted([min(before)] + sorted(before)[-2:]))
+
+    def test_backfill_is_idempotent(self):
+        unlogged = Group.objects.create(name='unlogged')
+        user_id = utils.fallback_user_pk()
+        self.assertEquals(backfill.backfill_range(
+            Group, (None, None), 2, user_id, timezone.now(),
+        ), (4, 1))
+        self.assertEquals(backfill.backfill_range(
+            Group, (None, None), 2, user_id, timezone.now(),
+        ), (4, 0))
+        self.assertEquals(
+            unicode(utils.get_simple_history(unlogged)['created_by']),
+            'admin',
+        )
+
+    def test_backfill_with_extras(self):
+        unlogged = Group.objects.create(name='unlogged')
+        Group.HISTORY_DATA_VIEW = 'lizard_history.tests.GroupApiView'
+        try:
+            backfill.backfill_range(
+                Group, (None, None), 2, utils.fallback_user_pk(),
+                timezone.now(), extras=True,
+            )
+        finally:
+            del Group.HISTORY_DATA_VIEW
+        history = utils.get_history(obj=unlogged)
+        self.assertEquals(len(history), 1)
+        history = utils.get_history(log_entry_id=history[0]['log_entry_id'])
+        self.assertEquals(history['api_object']['data'], {'name': 'unlogged'})
+
+    def test_coalesce_changes(self):
+        windows = coalesce.COALESCE
+        coalesce.COALESCE = {'auth.Group': 60}
+        coalesce._windows.clear()
+        try:
+            for name in ('autosave', 'final'):
+                utils.start_fake_request()
+                self.groups[0].name = name
+                self.groups[0].save()
+                utils.end_fake_request()
+        finally:
+            coalesce.COALESCE = windows
+            coalesce._windows.clear()
+        history = utils.get_history(obj=self.groups[0])
+        self.assertEquals(len(history), 2)
+        changes = [utils.get_history(log_entry_id=h['log_entry_id'])
+                   for h in history if h['action'] == 'Changed'][0]['changes']
+        self.assertEquals(changes['name'], {'old': 'group 0', 'new': 'final'})
+
+    def test_history_queryset(self):
+        utils.start_fake_request()
+        managers.HistoryQuerySet(Group).filter(
+            pk=self.groups[1].pk,
+        ).update(name='updated')
+        created = Group(pk=1000, name='bulk created')
+        managers.HistoryQuerySet(Group).bulk_create(
+            group for group in [created]
+        )
+        utils.end_fake_request()
+        self.assertEquals(
+            [h['action'] for h in utils.get_history(obj=self.groups[1])],
+            ['Changed', 'Created'],
+        )
+        self.assertEquals(len(utils.get_history(obj=created)), 1)
+        self.assertTrue(Group.objects.filter(pk=1000).exists())
+
+    def test_captured_but_not_saved(self):
+        utils.start_fake_request()
+        handlers.capture_pre_images(self.groups[1:])
+        self.groups[1].name = 'captured and saved'
+        self.groups[1].save()
+        utils.end_fake_request()
+        self.assertEquals(len(utils.get_history(obj=self.groups[1])), 2)
+        self.assertEquals(len(utils.get_history(obj=self.groups[2])), 1)
+
+    def test_bulk_write_skips_unchanged_objects(self):
+        unchanged = [Group.objects.create(name='unchanged %s' % i)
+                     for i in range(3)]
+        utils.start_fake_request()
+        for group in unchanged:
+            group.save()
+        for group in self.groups[1:]:
+            group.name = 'bulk ' + group.name
+            group.save()
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            utils.end_fake_request()
+            queries = connection.queries[start:]
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+
+        table = get_storage().model._meta.db_table
+        self.assertEquals(len([q for q in queries
+                               if q['sql'].startswith('INSERT') and
+                               table in q['sql']]), 1)
+        for group in self.groups[1:]:
+            self.assertEquals(len(utils.get_history(obj=group)), 2)
+        for group in unchanged:
+            self.assertEquals(utils.get_history(obj=group), [])
+
+    def test_copy_logentries_is_idempotent(self):
+        logged = get_storage('logentry').entries(utils.LIZARD_ACTIONS)
+        for i in range(2):
+            call_command('history_copy_logentries', stdout=StringIO())
+            self.assertEquals(history_models.HistoryEntry.objects.count(),
+                              logged.count())
+
+    def test_deferred_extras(self):
+        user = User.objects.create(username='viewer')
+        user.set_password('secret')
+        user.save()
+        self.client.login(username='viewer', password='secret')
+        defer_extras = handlers.DEFER_EXTRAS
+        handlers.DEFER_EXTRAS = True
+        Group.HISTORY_DATA_VIEW = 'lizard_history.tests.GroupApiView'
+        try:
+            utils.start_fake_request()
+            for group in self.groups[1:]:
+                group.name = 'deferred ' + group.name
+                group.save()
+            utils.end_fake_request()
+            log_entry_ids = [utils.get_history(obj=group)[0]['log_entry_id']
+                             for group in self.groups[1:]]
+            url = reverse('lizard_history_api_object', kwargs={
+                'log_entry_id': log_entry_ids[0],
+            })
+            self.assertEquals(self.client.get(url).status_code, 202)
+
+            Group.objects.filter(pk=self.groups[2].pk).delete()
+            call_command('history_compute_extras', stdout=StringIO())
+            self.assertEquals(history_models.PendingExtras.objects.count(), 0)
+            self.assertEquals(self.client.get(url).status_code, 200)
+        finally:
+            handlers.DEFER_EXTRAS = defer_extras
+            del Group.HISTORY_DATA_VIEW
+
+        history = utils.get_history(log_entry_id=log_entry_ids[0])
+        self.assertEquals(history['api_object']['data'],
+                          {'name': 'deferred group 1'})
+        history = utils.get_history(log_entry_id=log_entry_ids[1])
+        self.assertTrue(history[utils.EXTRAS_MISSING_KEY])
+
+    def test_group_without_key_is_logged_ungrouped(self):
+        groups.register(groups.HistoryGroup(
+            'test', ('auth.Group',), 'missing.ident',
+        ))
+        try:
+            utils.start_fake_request()
+            for group in self.groups[1:]:
+                group.name = 'ungrouped ' + group.name
+                group.save()
+            utils.end_fake_request()
+        finally:
+            del groups._groups_per_model['auth.Group']
+        for group in self.groups[1:]:
+            self.assertEquals(len(utils.get_history(obj=group)), 2)
+
+    def test_rebuild_summaries(self):
+        call_command('history_rebuild_summaries', chunk_size=1,
+                     stdout=StringIO())
+        key = history_models.summary_key(
+            utils.get_contenttype_id(self.groups[0]), self.groups[0].pk,
+        )
+        self.assertEquals(
+            history_models.HistorySummary.objects.get(pk=key).change_count, 1,
+        )
+        self.assertEquals(
+            summaries.simple_history_many(self.groups),
+            dict((group, utils.get_simple_history(group))
+                 for group in self.groups),
+        )
+
+        summary_table = summaries.SUMMARY_TABLE
+        summaries.SUMMARY_TABLE = True
+        try:
+            utils.start_fake_request()
+            self.groups[0].name = 'counted'
+            self.groups[0].save()
+            utils.end_fake_request()
+        finally:
+            summaries.SUMMARY_TABLE = summary_table
+        self.assertEquals(
+            history_models.HistorySummary.objects.get(pk=key).change_count, 2,
+        )
+
+    def test_get_state_at_after_prune(self):
+        for name in ('second change', 'third change'):
+            utils.start_fake_request()
+            self.groups[0].name = name
+            self.groups[0].save()
+            utils.end_fake_request()
+        call_command('history_rebuild_summaries', stdout=StringIO())
+
+        # The creation is pruned as well, its changes are folded into the
+        # second change.
+        summary_table = summaries.SUMMARY_TABLE
+        summaries.SUMMARY_TABLE = True
+        try:
+            pruner = retention.Pruner(retention.RetentionPolicy(
+                'auth.Group', max_entries=2, keep_first=False,
+            ))
+            self.assertEquals(sum(count for last_id, count in pruner.run()),
+                              2)
+        finally:
+            summaries.SUMMARY_TABLE = summary_table
+
+        self.assertEquals(utils.get_state_at(self.groups[0], timezone.now()),
+                          {'id': unicode(self.groups[0].pk),
+                           'name': u'third change'})
+        summary = history_models.HistorySummary.objects.get(
+            pk=history_models.summary_key(
+                utils.get_contenttype_id(self.groups[0]), self.groups[0].pk,
+            ),
+        )
+        self.assertEquals((summary.change_count, summary.created_at),
+                          (2, None))
+
+    def _export(self, **options):
+        """
+        Return the records exported with options.
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'history.jsonl.gz')
+        command = history_export.Command()
+        command.stdout = StringIO()
+        export_options = {
+            'models': [], 'since': None, 'until': None, 'user': None,
+            'chunk_size': 2, 'start_id': 0,
+        }
+        export_options.update(options)
+        try:
+            command.handle(path, **export_options)
+            with gzip.open(path) as export_file:
+                return [simplejson.loads(line) for line in export_file]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_export_resolves_blobs(self):
+        tree = {'name': 'area', 'children': [1, 2]}
+        storage = get_storage()
+        storage.build(
+            action_time=timezone.now(),
+            user_id=utils.fallback_user_pk(),
+            content_type_id=utils.get_contenttype_id(self.groups[1]),
+            object_pk=self.groups[1].pk,
+            object_repr=unicode(self.groups[1]),
+            action_flag=utils.LIZARD_CHANGE,
+            change_message=simplejson.dumps({
+                'changes': {},
+                blobs.EXTRAS_BLOBS_KEY: blobs.store_extras({'tree': tree}),
+            }),
+        ).save()
+
+        records = self._export(models=['auth.Group'])
+        self.assertEquals(len(records), 5)
+        self.assertEquals(
+            simplejson.loads(records[-1]['change_message'])['tree'], tree,
+        )
+        self.assertEquals(len(self._export(models=['auth'])), 5)
+
+    def test_export_unknown_model(self):
+        self.assertRaises(CommandError, self._export, models=['auth.Nothing'])
+
+    def test_summary_survives_user_deletion(self):
+        editor = User.objects.create(username='editor')
+        summary = history_models.HistorySummary.objects.create(
+            key=history_models.summary_key(
+                utils.get_contenttype_id(self.groups[1]), self.groups[1].pk,
+            ),
+            content_type_id=utils.get_contenttype_id(self.groups[1]),
+            object_key=unicode(self.groups[1].pk),
+            created_at=timezone.now(),
+            created_by=editor,
+        )
+        editor.delete()
+        summary = history_models.HistorySummary.objects.get(pk=summary.pk)
+        self.assertEquals(summary.created_by, None)
+
+    def test_archive_caching_headers(self):
+        user = User.objects.create(username='viewer')
+        user.set_password('secret')
+        user.save()
+        self.client.login(username='viewer', password='secret')
+        Group.HISTORY_DATA_VIEW = 'lizard_history.tests.GroupApiView'
+        try:
+            utils.start_fake_request()
+            self.groups[1].name = 'archived'
+            self.groups[1].save()
+            utils.end_fake_request()
+        finally:
+            del Group.HISTORY_DATA_VIEW
+        log_entry_id = utils.get_history(
+            obj=self.groups[1],
+        )[0]['log_entry_id']
+        url = reverse('lizard_history_api_object', kwargs={
+            'log_entry_id': log_entry_id,
+        })
+
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['ETag'], views.archive_etag(log_entry_id))
+        self.assertEquals(response['Cache-Control'],
+                          'private, max-age=%s' % views.ARCHIVE_MAX_AGE)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+
+        url = reverse('lizard_history_api_object', kwargs={
+            'log_entry_id': log_entry_id + 1000,
+        })
+        self.assertEquals(self.client.get(url).status_code, 404)
@@ -27,5 +27,12 @@ urlpatterns = patterns(
     url(r'^wbconfiguration/area_configuration/(?P<log_entry_id>[0-9]+)/$',
         views.AreaConfigurationView.as_view(),
         name=NAME_PREFIX + 'wbconfiguration_area_configuration'),
+    url(r'^history/(?P<app_label>[^/]+)/(?P<model>[^/]+)/'
+        '(?P<object_id>[^/]+)/$',
+        views.HistoryView.as_view(),
+        name=NAME_PREFIX + 'history'),
+    url(r'^stats/$',
+        views.StatsView.as_view(),
+        name=NAME_PREFIX + 'stats'),
     )
 urlpatterns += debugmode_urlpatterns()
@@ -1,26 +1,35 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 from django.db.models import Model
+from django.db.models import Q
 from django.http import HttpRequest
 
 from django.utils import simplejson
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import ugettext as _
 
+from django.core.cache import cache
 from django.core.serializers import serialize
 from django.core.serializers.json import DateTimeAwareJSONEncoder
 
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.admin.models import LogEntry
 
 from django.contrib.auth.models import User
 from django.contrib.auth.models import AnonymousUser
 
 from tls import request as tls_request
 from werkzeug.local import Local, release_local
+from lizard_history import blobs
+from lizard_history import codec
+from lizard_history import instrumentation
+from lizard_history import registry
+from lizard_history.signals import fake_request_started
 from lizard_history.signals import ops_done
+from lizard_history.storage import get_storage
 from django_load.core import load_object
 
 import datetime
 import hashlib
+import time
 
 
 WBCONFIGURATION_MODELS = (
@@ -32,6 +41,15 @@ WBCONFIGURATION_MODELS = (
 LIZARD_ADDITION = 4
 LIZARD_CHANGE = 5
 LIZARD_DELETION = 6
+LIZARD_ACTIONS = (LIZARD_ADDITION, LIZARD_CHANGE, LIZARD_DELETION)
+
+EXTRAS_PENDING_KEY = 'extras_pending'
+EXTRAS_MISSING_KEY = 'extras_missing'
+# Message key of the full field values, see checkpoints.
+CHECKPOINT_KEY = 'checkpoint'
+
+# Number of entries fetched per query by iter_history.
+HISTORY_PAGE_SIZE = 500
 
 _local = Local()
 fake_request = _local('fake_request')
@@ -52,6 +70,7 @@ def start_fake_request(**kwargs):
     for k, v in kwargs.items():
         setattr(fake_request, k, v)
     _local.fake_request = fake_request
+    fake_request_started.send(None)
 
 
 def end_fake_request():
@@ -63,12 +82,78 @@ def end_fake_request():
     release_local(_local)
 
 
+# Process local cache of the fallback superuser pk. Changes of superusers
+# bump a generation counter in django's cache, which is checked like the
+# one of the registry of monitored models, see registry.
+_lookups = {}
+SUPERUSER_PK_KEY = 'superuser_pk'
+GENERATION_KEY = 'generation'
+LOADED_AT_KEY = 'loaded_at'
+CHECKED_AT_KEY = 'checked_at'
+SUPERUSER_GENERATION_CACHE_KEY = 'lizard_history_superuser_generation'
+
+
+def _superuser_generation():
+    try:
+        return cache.get(SUPERUSER_GENERATION_CACHE_KEY)
+    except Exception:  # A broken cache must not break saving.
+        return None
+
+
+def invalidate_lookups(instance=None, **kwargs):
+    """
+    Clear the cached superuser pk, in other processes as well.
+
+    Connected to saves and deletes of users, ignoring those that cannot
+    change the fallback superuser.
+    """
+    if (instance is not None and not instance.is_superuser and
+        instance.pk != _lookups.get(SUPERUSER_PK_KEY)):
+        return
+    _lookups.clear()
+    try:
+        cache.incr(SUPERUSER_GENERATION_CACHE_KEY)
+    except ValueError:
+        cache.set(SUPERUSER_GENERATION_CACHE_KEY, 1)
+    except Exception:
+        pass
+
+
+def _superuser_pk_is_stale():
+    if not SUPERUSER_PK_KEY in _lookups:
+        return True
+    now = time.time()
+    if now - _lookups[LOADED_AT_KEY] > registry.TIMEOUT:
+        return True
+    if now - _lookups[CHECKED_AT_KEY] > registry.CHECK_INTERVAL:
+        _lookups[CHECKED_AT_KEY] = now
+        return _superuser_generation() != _lookups[GENERATION_KEY]
+    return False
+
+
+def fallback_user_pk():
+    """ Return pk of the first superuser, cached. """
+    if _superuser_pk_is_stale():
+        generation = _superuser_generation()
+        pk = User.objects.filter(is_superuser=True).order_by(
+            'pk',
+        ).values_list('pk', flat=True)[0]
+        now = time.time()
+        _lookups.update({
+            SUPERUSER_PK_KEY: pk,
+            GENERATION_KEY: generation,
+            LOADED_AT_KEY: now,
+            CHECKED_AT_KEY: now,
+        })
+    return _lookups[SUPERUSER_PK_KEY]
+
+
 def user_pk():
     """ Determine the user for this request."""
-    user = active_request().user
+    user = getattr(active_request(), 'user', None)
     if isinstance(user, AnonymousUser) or not user:
         # Get the first superuser
-        return User.objects.filter(is_superuser=True)[0].pk
+        return fallback_user_pk()
     return user.pk
 
 
@@ -129,64 +214,77 @@ def _model_dict(obj):
     return model_dict
 
 
-def _model_dict_based_on_dict(obj):
+def get_contenttype_id(obj):
     """
-    Return a dict representing the Django model instance.
+    Return contenttype id or None.
 
-    Uses objects __dict__ attribute, to include fields from parent models.
+    Currently supported are django models. Django caches the ids.
     """
-    if obj is None:
-        return {}
-
-    model_dict = {}
+    if isinstance(obj, Model):
+        return ContentType.objects.get_for_model(obj.__class__).pk
+    else:
+        return None
 
-    for k, v in obj.__dict__.items():
-        if not k.startswith('_'):
-            model_dict[k] = unicode(v)  # Mainly to get rid of datetimes
 
-    return model_dict
+_diff_keys_per_model = {}
+_MISSING = object()
 
 
-def get_contenttype_id(obj):
+def _diff_keys(model):
     """
-    Return contenttype id or None.
+    Return the __dict__ keys to diff for instances of model.
 
-    Currently supported are django models.
+    These are the attnames of the concrete fields, including those of
+    parent models, and the names of the m2m fields. Computed once per
+    model.
     """
-    if isinstance(obj, Model):
-        return ContentType.objects.get_for_model(obj).pk
-    else:
-        return None
+    try:
+        return _diff_keys_per_model[model]
+    except KeyError:
+        keys = tuple(
+            [f.attname for f in model._meta.fields] +
+            [f.name for f in model._meta.many_to_many]
+        )
+        _diff_keys_per_model[model] = keys
+        return keys
 
 
-def _dict_diff(dict1, dict2):
+def _model_diff(obj1, obj2):
     """
-    Return a dict representing the difference.
+    Return diff for Django models or None objects
 
-    Assumes two flat dicts.
+    Values are compared natively first. Only values that differ are
+    converted to unicode, and they only count as changed if their unicode
+    differs as well. A missing object has None for all old or new values.
     """
-    keys = set(dict1.keys()) | set(dict2.keys())
+    if obj1 is None and obj2 is None:
+        return {}
+    model = obj1.__class__ if obj2 is None else obj2.__class__
+    dict1 = {} if obj1 is None else obj1.__dict__
+    dict2 = {} if obj2 is None else obj2.__dict__
+
     result = {}
-    for k in keys:
-        if not dict1.get(k) == dict2.get(k):
+    for k in _diff_keys(model):
+        v1 = dict1.get(k, _MISSING)
+        v2 = dict2.get(k, _MISSING)
+        if v1 is v2:
+            continue
+        try:
+            if v1 == v2:
+                continue
+        except TypeError:  # For example naive versus aware datetimes
+            pass
+        old = None if v1 is _MISSING else unicode(v1)
+        new = None if v2 is _MISSING else unicode(v2)
+        if not old == new:
             result[k] = {
-                'old': dict1.get(k),
-                'new': dict2.get(k),
+                'old': old,
+                'new': new,
             }
 
     return result
 
 
-def _model_diff(obj1, obj2):
-    """
-    Return diff for Django models or None objects
-    """
-    return _dict_diff(
-        _model_dict_based_on_dict(obj1),
-        _model_dict_based_on_dict(obj2),
-    )
-
-
 def _are_instance_or_none(obj1, obj2, klass):
     """
     Return True if one or both objects are instance of klass
@@ -223,14 +321,14 @@ def _api_object(obj, view):
     }
 
 
-def _other_object(obj, view):
+def _other_object(obj, view, user):
     """
     Return data for general get request on view.
     """
     # Our view expects a request, so let's make one.
     
     view_request = HttpRequest()
-    view_request.user = active_request().user
+    view_request.user = user
     view_request.GET = view_request.GET.copy()  # Make request mutable.
     view_request.GET.update(object_id=obj.area.ident)
 
@@ -239,38 +337,76 @@ def _other_object(obj, view):
     }
 
 
-def _custom_extras(obj):
+@instrumentation.instrumented('custom_extras')
+def _custom_extras(obj, user=None):
     """
     Return custom properties to save in history.
+
+    The user defaults to the user of the active request.
     """
     if not hasattr(obj, 'HISTORY_DATA_VIEW'):
         return {}
     view = load_object(obj.HISTORY_DATA_VIEW)
 
-    view.user = active_request().user  # For the wbconfiguration to work...
+    if user is None:
+        user = active_request().user
+    view.user = user  # For the wbconfiguration to work...
 
     if hasattr(view, 'get_object_for_api'):
         return _api_object(obj, view)
 
-    return _other_object(obj, view)
+    return _other_object(obj, view, user)
 
 
-def change_message(old_object, new_object, instance):
+def extras_for_storage(extras):
+    """
+    Return custom extras in the form they are stored in.
+    """
+    sections = {}
+    if extras and blobs.SPLIT_SECTIONS:
+        extras, sections = blobs.split_sections(extras)
+    if extras and blobs.DEDUPLICATE_EXTRAS:
+        extras = {blobs.EXTRAS_BLOBS_KEY: blobs.store_extras(extras)}
+    if sections:
+        extras = dict(extras)
+        extras.update(sections)
+    return extras
+
+
+@instrumentation.instrumented('change_message')
+def change_message(old_object, new_object, instance=None, summary=None,
+                   user=None, defer_extras=False, checkpoint=None,
+                   extras=True):
     """
     Return a suitable change message.
+
+    The summary is taken from instance if given, see _custom_extras for
+    the user. With defer_extras, the custom extras are replaced by a
+    marker, to be computed later by handlers.compute_pending_extras.
+    Without extras, there are no custom extras at all. A checkpoint
+    snapshot is only included if there are changes.
     """
     message_object = {
         'changes': _diff(old_object, new_object),
     }
 
     if hasattr(instance, 'lizard_history_summary'):
-        message_object.update(summary=instance.lizard_history_summary)
+        summary = instance.lizard_history_summary
+    if summary is not None:
+        message_object.update(summary=summary)
 
-    message_object.update(_custom_extras(new_object))
+    if extras and defer_extras:
+        message_object[EXTRAS_PENDING_KEY] = True
+    elif extras:
+        message_object.update(extras_for_storage(
+            _custom_extras(new_object, user=user),
+        ))
 
     # If there are no changes, we need no log.
     if message_object == {'changes': {}}:
         return None
+    if checkpoint is not None:
+        message_object[CHECKPOINT_KEY] = checkpoint
 
     return simplejson.dumps(
         message_object,
@@ -283,30 +419,34 @@ def get_simple_history(obj):
     if obj is None:
         return None
 
+    from lizard_history import summaries
+    if summaries.SUMMARY_TABLE:
+        return summaries.simple_history_many([obj])[obj]
+
+    storage = get_storage()
     content_type = ContentType.objects.get_for_model(obj)
-    object_id = obj.pk
+    entries = storage.entries(LIZARD_ACTIONS).filter(
+        content_type=content_type,
+        **storage.object_filter(obj.pk)
+    )
 
     try:
-        created = LogEntry.objects.filter(
-            object_id=object_id,
-            content_type=content_type,
-            action_flag=LIZARD_ADDITION
+        created = entries.filter(
+            **{storage.action_field: LIZARD_ADDITION}
         ).latest('action_time')
         created_by = created.user.get_full_name() or created.user
         datetime_created = created.action_time
-    except LogEntry.DoesNotExist:
+    except storage.model.DoesNotExist:
         created_by = None
         datetime_created = None
 
     try:
-        modified = LogEntry.objects.filter(
-            object_id=object_id,
-            content_type=content_type,
-            action_flag=LIZARD_CHANGE
+        modified = entries.filter(
+            **{storage.action_field: LIZARD_CHANGE}
         ).latest('action_time')
         modified_by = modified.user.get_full_name() or modified.user
         datetime_modified = modified.action_time
-    except LogEntry.DoesNotExist:
+    except storage.model.DoesNotExist:
         modified_by = None
         datetime_modified = None
 
@@ -320,17 +460,101 @@ def get_simple_history(obj):
     return simple_history
 
 
-def _log_entry_to_dict(log_entry, include_data=False):
-    """ Return a dict with selected info from log_entry """
-    data = simplejson.loads(log_entry.change_message)
+def _entries_per_object(objs, action_flags, defer_payload=False):
+    """
+    Return dict of objs to lists of their entries, newest first.
+
+    Does one query per content type, with the users selected along.
+    """
+    storage = get_storage()
+    objs_per_content_type = {}
+    for obj in objs:
+        if obj is None:
+            continue
+        content_type = ContentType.objects.get_for_model(obj)
+        objs_per_content_type.setdefault(content_type, []).append(obj)
+
+    result = {}
+    for content_type, content_type_objs in objs_per_content_type.items():
+        objs_per_key = {}
+        for obj in content_type_objs:
+            result[obj] = []
+            key = storage.normalize_pk(obj.pk)
+            objs_per_key.setdefault(key, []).append(obj)
+
+        entries = storage.entries(action_flags).filter(
+            content_type=content_type,
+            **storage.objects_filter([obj.pk for obj in content_type_objs])
+        ).select_related('user').order_by('-action_time', '-pk')
+        if defer_payload:
+            entries = entries.defer(storage.payload_field)
+
+        for entry in entries:
+            for obj in objs_per_key.get(storage.object_key(entry), []):
+                result[obj].append(entry)
+
+    return result
+
+
+def _simple_history_from_entries(entries):
+    """
+    Return simple history dict from entries, newest first.
+    """
+    simple_history = {
+        'datetime_created': None,
+        'created_by': None,
+        'datetime_modified': None,
+        'modified_by': None,
+    }
+    for entry in entries:
+        if (entry.action_flag == LIZARD_ADDITION and
+            simple_history['datetime_created'] is None):
+            simple_history['created_by'] = (
+                entry.user.get_full_name() or entry.user)
+            simple_history['datetime_created'] = entry.action_time
+        elif (entry.action_flag == LIZARD_CHANGE and
+              simple_history['datetime_modified'] is None):
+            simple_history['modified_by'] = (
+                entry.user.get_full_name() or entry.user)
+            simple_history['datetime_modified'] = entry.action_time
+    return simple_history
+
+
+def get_simple_history_many(objs):
+    """
+    Return dict of objs to their simple history, see get_simple_history.
+    """
+    from lizard_history import summaries
+    if summaries.SUMMARY_TABLE:
+        return summaries.simple_history_many(objs)
+
+    entries_per_object = _entries_per_object(
+        objs,
+        action_flags=(LIZARD_ADDITION, LIZARD_CHANGE),
+        defer_payload=True,
+    )
+    return dict((obj, _simple_history_from_entries(entries))
+                for obj, entries in entries_per_object.items())
+
+
+def get_history_many(objs):
+    """
+    Return dict of objs to their history lists, see get_history.
+    """
+    entries_per_object = _entries_per_object(objs, LIZARD_ACTIONS)
+    return dict((obj, [_log_entry_to_dict(l) for l in entries])
+                for obj, entries in entries_per_object.items())
+
 
+def _log_entry_base_dict(log_entry):
+    """ Return a dict with the info from log_entry outside its message """
     action_flag_mapping = {
         LIZARD_CHANGE: _('Changed'),
         LIZARD_ADDITION: _('Created'),
         LIZARD_DELETION: _('Deleted'),
     }
 
-    result = {
+    return {
         'action': action_flag_mapping[log_entry.action_flag],
         'user': str(log_entry.user),
         'datetime': str(log_entry.action_time),
@@ -338,30 +562,209 @@ def _log_entry_to_dict(log_entry, include_data=False):
         'object_repr': log_entry.object_repr,
     }
 
+
+def _log_entry_to_dict(log_entry, include_data=False,
+                       resolve_sections=True):
+    """
+    Return a dict with selected info from log_entry
+
+    Without resolve_sections, split api_object data is left as section
+    references, see blobs.resolve_sections.
+    """
+    data = simplejson.loads(codec.decode(log_entry.change_message))
+    data.pop(CHECKPOINT_KEY, None)
+
+    result = _log_entry_base_dict(log_entry)
+
     # Include summary regardless of include_data argument
     result.update(summary=data.get('summary', ''))
 
     if include_data:
-        result.update(data)
+        result.update(blobs.resolve_extras(data, sections=resolve_sections))
 
     return result
 
 
-def get_history(obj=None, log_entry_id=None, include_data=True):
+def history_cursor(log_entry):
+    """
+    Return keyset cursor for the entries older than log_entry.
+    """
+    return '%s_%s' % (log_entry.action_time.isoformat(), log_entry.pk)
+
+
+def _parse_history_cursor(cursor):
+    """
+    Return (action_time, pk) for cursor, raise ValueError if invalid.
+    """
+    action_time, pk = cursor.rsplit('_', 1)
+    action_time = parse_datetime(action_time)
+    if action_time is None:
+        raise ValueError('Invalid history cursor %r' % cursor)
+    return action_time, int(pk)
+
+
+def iter_content_type_history(content_type, object_pk, after=None,
+                              limit=None, include_data=False):
+    """
+    Iterate over the history of an object, newest first.
+
+    See iter_history, this variant does not need the object itself.
+    """
+    storage = get_storage()
+    entries = storage.entries(LIZARD_ACTIONS).filter(
+        content_type=content_type,
+        **storage.object_filter(object_pk)
+    ).select_related('user').order_by('-action_time', '-pk')
+    if not include_data:
+        entries = entries.defer(storage.payload_field)
+
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page = entries
+        if after:
+            action_time, pk = _parse_history_cursor(after)
+            page = page.filter(
+                Q(action_time__lt=action_time) |
+                Q(action_time=action_time, pk__lt=pk)
+            )
+        page_size = HISTORY_PAGE_SIZE
+        if remaining is not None:
+            page_size = min(page_size, remaining)
+
+        count = 0
+        for log_entry in page[:page_size].iterator():
+            count += 1
+            after = history_cursor(log_entry)
+            if include_data:
+                result = _log_entry_to_dict(log_entry, include_data=True)
+            else:
+                result = _log_entry_base_dict(log_entry)
+            result.update(cursor=after)
+            yield result
+
+        if remaining is not None:
+            remaining -= count
+        if count < page_size:
+            break
+
+
+def iter_history(obj, after=None, limit=None, include_data=False):
+    """
+    Iterate over the history of obj, newest first.
+
+    Pages through the entries using keyset pagination on (action_time,
+    id), so memory use does not grow with the length of the history.
+    Every item has a 'cursor', to be passed as after to continue after
+    that item. At most limit items are returned, all if limit is None.
+    Only with include_data are the messages loaded and decoded, one row
+    at a time; the summary is part of the data.
+    """
+    return iter_content_type_history(
+        ContentType.objects.get_for_model(obj),
+        obj.pk,
+        after=after,
+        limit=limit,
+        include_data=include_data,
+    )
+
+
+def _base_state(log_entry, data):
+    """
+    Return the complete state after log_entry, or None if not known.
+    """
+    if CHECKPOINT_KEY in data:
+        return dict(data[CHECKPOINT_KEY])
+    if log_entry.action_flag == LIZARD_ADDITION:
+        return dict((k, v['new']) for k, v in data['changes'].items())
+    if log_entry.action_flag == LIZARD_DELETION:
+        return {}
+    return None
+
+
+def get_content_type_state_at(content_type, object_pk, timestamp):
+    """
+    Return the field values of an object at timestamp, or None.
+
+    See get_state_at, this variant does not need the object itself.
+    """
+    from lizard_history import checkpoints
+    storage = get_storage()
+    entries = storage.entries(LIZARD_ACTIONS).filter(
+        content_type=content_type,
+        action_time__lte=timestamp,
+        **storage.object_filter(object_pk)
+    ).order_by('-action_time', '-pk')
+
+    # A base is expected within the first window, the rest of the
+    # entries are only read for histories that predate the checkpoints.
+    window = checkpoints.CHECKPOINT_INTERVAL + 1
+    if checkpoints.CHECKPOINT_INTERVAL:
+        parts = (entries[:window], entries[window:])
+    else:
+        parts = (entries,)
+
+    state = None
+    diffs = []
+    for part in parts:
+        for log_entry in part.iterator():
+            if log_entry.action_flag == LIZARD_DELETION and not diffs:
+                return None  # Deleted before timestamp
+            data = simplejson.loads(codec.decode(log_entry.change_message))
+            state = _base_state(log_entry, data)
+            if state is not None:
+                break
+            diffs.append(data['changes'])
+        if state is not None:
+            break
+
+    if state is None:
+        if not diffs:
+            return None  # No history before timestamp
+        state = {}  # Only the fields that changed are known
+    for changes in reversed(diffs):
+        for k, v in changes.items():
+            state[k] = v['new']
+    return state
+
+
+def get_state_at(obj, timestamp):
+    """
+    Return dict of the field values of obj at timestamp.
+
+    The state is rebuilt from the stored diffs, starting at the nearest
+    checkpoint, creation or deletion before timestamp. Values are in the
+    unicode form of the diffs, with the attnames of the fields as keys.
+    Return None if obj did not exist at timestamp or has no history
+    before it. If the history does not start at the creation of obj,
+    only the fields that changed are included.
+    """
+    return get_content_type_state_at(
+        ContentType.objects.get_for_model(obj),
+        obj.pk,
+        timestamp,
+    )
+
+
+def get_history(obj=None, log_entry_id=None, include_data=True,
+                resolve_sections=True):
     """
     Return full history for obj or changes for log_entry_id
     """
+    storage = get_storage()
+
     if log_entry_id:
-        log_entry = LogEntry.objects.get(pk=log_entry_id)
-        return _log_entry_to_dict(log_entry, include_data=include_data)
+        log_entry = storage.model.objects.get(pk=log_entry_id)
+        return _log_entry_to_dict(
+            log_entry,
+            include_data=include_data,
+            resolve_sections=resolve_sections,
+        )
 
     content_type = ContentType.objects.get_for_model(obj)
-    object_id = obj.pk
 
-    entries = LogEntry.objects.filter(
-        object_id=object_id,
+    entries = storage.entries(LIZARD_ACTIONS).filter(
         content_type=content_type,
-        action_flag__in=[LIZARD_ADDITION, LIZARD_CHANGE, LIZARD_DELETION],
+        **storage.object_filter(obj.pk)
     )
 
     return [_log_entry_to_dict(l) for l in entries]
@@ -378,7 +781,7 @@ def get_specific_history(models, area):
 
     # Works for objects where complete log is stored in single logentry
     # with area_ident in the object_repr field.
-    entries = LogEntry.objects.filter(
+    entries = get_storage().model.objects.filter(
         content_type__in=content_types,
         object_repr=area.ident,
     )
@@ -1,90 +1,276 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.utils.http import parse_etags
+from django.utils import timezone
+from django.utils.http import quote_etag
+
 from djangorestframework.response import Response
 from djangorestframework.views import View
 from djangorestframework import status
+from lizard_history import blobs
+from lizard_history import coalesce
+from lizard_history import instrumentation
 from lizard_history import utils
+from lizard_history import writer
+from lizard_history.lru import LRUCache
+from lizard_history.storage import STORAGE
+from lizard_history.storage import get_storage
+
+# Seconds that clients may cache archive responses, default a year.
+ARCHIVE_MAX_AGE = getattr(
+    settings, 'LIZARD_HISTORY_ARCHIVE_MAX_AGE', 365 * 24 * 60 * 60,
+)
+ARCHIVE_CACHE_SIZE = getattr(
+    settings, 'LIZARD_HISTORY_ARCHIVE_CACHE_SIZE', 100,
+)
+
+# (log entry id, version) to the history of that entry, including data
+# but with unresolved sections.
+archive_cache = LRUCache(ARCHIVE_CACHE_SIZE)
 
 
-class ApiObjectView(View):
+def _pending_response():
     """
-    Show a historic api object stored in the admin log
+    Return response for entries whose snapshot is not computed yet.
+    """
+    return Response(
+        status.HTTP_202_ACCEPTED,
+        {'success': False, 'message': 'snapshot pending'},
+    )
+
+
+def archive_etag(log_entry_id, version=None):
+    """
+    Return the quoted ETag of the archive data of log_entry_id.
+    """
+    etag = 'lizard-history-%s-%s' % (STORAGE, log_entry_id)
+    if version is not None:
+        etag += '-' + version
+    return quote_etag(etag)
+
+
+def entry_version(log_entry_id):
+    """
+    Return (version, changing) of log_entry_id.
+
+    Entries only change while they can be coalesced with later changes,
+    see coalesce. Without coalescing, the version is None. Raise
+    IndexError if the entry does not exist.
+    """
+    entries = get_storage().model.objects.filter(pk=log_entry_id)
+    if not coalesce.COALESCE:
+        if not entries.exists():
+            raise IndexError(log_entry_id)
+        return None, False
+    action_time, content_type_id = entries.values_list(
+        'action_time', 'content_type',
+    )[0]
+    window = coalesce.window(content_type_id)
+    changing = (window is not None and
+                timezone.now() - action_time < window)
+    return action_time.strftime('%Y%m%d%H%M%S%f'), changing
+
+
+def archived_history(log_entry_id, version=None):
+    """
+    Return the history of log_entry_id, including data.
+
+    Split api_object data is not resolved, see archive_section. Complete
+    histories are cached per version, since a version never changes. The
+    result is shared through the cache and must not be modified.
     """
+    key = (int(log_entry_id), version)
+    history = archive_cache.get(key)
+    if history is None:
+        history = utils.get_history(
+            log_entry_id=int(log_entry_id),
+            resolve_sections=False,
+        )
+        if not history.get(utils.EXTRAS_PENDING_KEY):
+            archive_cache.set(key, history)
+    return history
+
+
+class ArchiveView(View):
+    """
+    Base view for the archive data of a log entry.
+
+    Log entries do not change once their snapshot is computed, so
+    responses get a strong ETag and may be cached for ARCHIVE_MAX_AGE.
+    Conditional requests are answered without loading the entry. Entries
+    that may still be coalesced are revalidated on every request.
+    Subclasses implement archive_content.
+    """
+    def archive_content(self, request, history):
+        """
+        Return the content for history, or a Response.
+        """
+        raise NotImplementedError
+
+    def archive_section(self, history, name):
+        """
+        Return section name of the api_object data or of history itself.
+
+        Of split api_object data, only the requested section is loaded.
+        """
+        sections = history.get(blobs.SECTIONS_KEY, {})
+        if name in sections:
+            return blobs.resolve_blob(sections[name])
+
+        # Anticipate new way of storing archive JSON
+        if 'api_object' in history:
+            history.update(history['api_object'].get('data', {}))
+
+        try:
+            return history[name]
+        except KeyError:
+            return Response(status.HTTP_404_NOT_FOUND)
+
     def get(self, request, log_entry_id):
         if request.user.is_anonymous():
             return Response(status.HTTP_403_FORBIDDEN)
-        history = utils.get_history(
-            log_entry_id=log_entry_id,
-        )
 
+        try:
+            version, changing = entry_version(log_entry_id)
+        except IndexError:
+            return Response(status.HTTP_404_NOT_FOUND)
+        etag = archive_etag(log_entry_id, version)
+        headers = {
+            'ETag': etag,
+            'Cache-Control': 'private, max-age=%s' % (
+                0 if changing else ARCHIVE_MAX_AGE),
+        }
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            if '*' in etags or etag in [quote_etag(e) for e in etags]:
+                return Response(status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        history = archived_history(log_entry_id, version)
+        if history.get(utils.EXTRAS_PENDING_KEY):
+            return _pending_response()
+
+        content = self.archive_content(request, dict(history))
+        if isinstance(content, Response):
+            return content
+        return Response(status.HTTP_200_OK, content, headers=headers)
+
+
+class ApiObjectView(ArchiveView):
+    """
+    Show a historic api object stored in the admin log
+    """
+    def archive_content(self, request, history):
+        blobs.resolve_sections(history)
         if 'api_object' in history:
             return history['api_object']
 
         return Response(status.HTTP_404_NOT_FOUND)
 
 
-class OtherObjectView(View):
+class OtherObjectView(ArchiveView):
     """
     Show a historic other object stored in the admin log
     """
-    def get(self, request, log_entry_id):
-        if request.user.is_anonymous():
-            return Response(status.HTTP_403_FORBIDDEN)
-        history = utils.get_history(
-            log_entry_id=log_entry_id,
-        )
-
+    def archive_content(self, request, history):
         if 'tree' in history:
             return history['tree']
 
         return Response(status.HTTP_404_NOT_FOUND)
 
 
-class AreaObjectConfigurationView(View):
+class AreaObjectConfigurationView(ArchiveView):
     """
     Show archive data for area object configuration.
     Supply an object_type with the request.
     """
-    def get(self, request, log_entry_id):
-
-        if request.user.is_anonymous():
-            return Response(status.HTTP_403_FORBIDDEN)
-
-        history = utils.get_history(
-            log_entry_id=log_entry_id,
-        )
-
-        # Anticipate new way of storing archive JSON
-        if 'api_object' in history:
-            history.update(history['api_object']['data'])
-
+    def archive_content(self, request, history):
         try:
             area_object_type = request.GET['area_object_type']
-            return history[area_object_type.lower()]
         except KeyError:
             return Response(status.HTTP_404_NOT_FOUND)
+        return self.archive_section(history, area_object_type.lower())
 
 
-class AreaConfigurationView(View):
+class AreaConfigurationView(ArchiveView):
     """
     Show archive data for area configuration.
     Supply a grid_name with the request.
     """
-    def get(self, request, log_entry_id):
+    def archive_content(self, request, history):
+        try:
+            grid_name = request.GET['grid_name']
+        except KeyError:
+            return Response(status.HTTP_404_NOT_FOUND)
+        return self.archive_section(history, grid_name.lower())
 
-        if request.user.is_anonymous():
-            return Response(status.HTTP_403_FORBIDDEN)
 
-        history = utils.get_history(
-            log_entry_id=log_entry_id,
-        )
+class HistoryView(View):
+    """
+    Show a page of the history of an object, newest first.
 
-        # Anticipate new way of storing archive JSON
-        if 'api_object' in history:
-            history.update(history['api_object']['data'])
+    Supply limit (default 50, maximum 500), include_data and the after
+    cursor with the request. The next cursor is None on the last page.
+    """
+    default_limit = 50
+    max_limit = 500
+
+    def get(self, request, app_label, model, object_id):
+
+        if request.user.is_anonymous():
+            return Response(status.HTTP_403_FORBIDDEN)
 
         try:
-            grid_name = request.GET['grid_name']
-            return history[grid_name.lower()]
-        except KeyError:
+            content_type = ContentType.objects.get_by_natural_key(
+                app_label, model,
+            )
+            limit = min(
+                int(request.GET.get('limit', self.default_limit)),
+                self.max_limit,
+            )
+        except (ContentType.DoesNotExist, ValueError):
             return Response(status.HTTP_404_NOT_FOUND)
+
+        try:
+            results = list(utils.iter_content_type_history(
+                content_type,
+                object_id,
+                after=request.GET.get('after'),
+                limit=limit,
+                include_data=request.GET.get('include_data') in (
+                    '1', 'true',
+                ),
+            ))
+        except ValueError:  # Invalid cursor
+            return Response(status.HTTP_400_BAD_REQUEST)
+
+        next_cursor = None
+        if results and len(results) == limit:
+            next_cursor = results[-1]['cursor']
+
+        return {
+            'results': results,
+            'next': next_cursor,
+        }
+
+
+class StatsView(View):
+    """
+    Show the instrumentation stats and the asynchronous writer counters.
+
+    Only available to staff.
+    """
+    def get(self, request):
+        if not request.user.is_staff:
+            return Response(status.HTTP_403_FORBIDDEN)
+
+        result = {
+            'instrument': instrumentation.INSTRUMENT,
+            'stats': instrumentation.stats.summary(),
+            'archive_cache': archive_cache.stats(),
+        }
+        if writer.ASYNC:
+            result['writer'] = writer.get_writer().stats()
+        return result
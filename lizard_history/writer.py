@@ -0,0 +1,213 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Optional background writer for history records.
+
+With LIZARD_HISTORY_ASYNC = True, the request thread only captures the
+changes of a request into a record and puts it on a bounded queue. The
+queued records hold the field values of the objects, not the instances
+themselves. Worker threads take records off the queue in batches, diff
+them, render the custom extras and insert the log entries.
+"""
+import Queue
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+
+from lizard_history import storage
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 'block'
+DROP = 'drop'
+INLINE = 'inline'
+
+ASYNC = getattr(settings, 'LIZARD_HISTORY_ASYNC', False)
+QUEUE_SIZE = getattr(settings, 'LIZARD_HISTORY_ASYNC_QUEUE_SIZE', 1000)
+WORKERS = getattr(settings, 'LIZARD_HISTORY_ASYNC_WORKERS', 1)
+# What to do with a record when the queue is full: BLOCK, DROP or INLINE.
+FULL_POLICY = getattr(settings, 'LIZARD_HISTORY_ASYNC_FULL_POLICY', BLOCK)
+# Maximum number of records processed in one go by a worker.
+BATCH_SIZE = getattr(settings, 'LIZARD_HISTORY_ASYNC_BATCH_SIZE', 50)
+# Seconds to wait for the queue to drain on shutdown.
+SHUTDOWN_TIMEOUT = getattr(
+    settings, 'LIZARD_HISTORY_ASYNC_SHUTDOWN_TIMEOUT', 30,
+)
+
+# LogEntry.action_time has auto_now, so an entry written by a worker would
+# get the time of the write instead of the time of the change. Entries of
+# different workers could then end up out of order.
+if ASYNC and storage.STORAGE != storage.HISTORYENTRY_STORAGE:
+    raise ImproperlyConfigured(
+        "LIZARD_HISTORY_ASYNC requires LIZARD_HISTORY_STORAGE = "
+        "'historyentry'.")
+
+_STOP = object()
+
+
+class AsyncHistoryWriter(object):
+    """
+    Bounded queue of records with worker threads that process them.
+
+    Process is a callable that takes a list of records.
+    """
+    def __init__(self, process, queue_size=QUEUE_SIZE, workers=WORKERS,
+                 full_policy=FULL_POLICY, batch_size=BATCH_SIZE):
+        if not full_policy in (BLOCK, DROP, INLINE):
+            raise ValueError('Unknown full policy %r' % full_policy)
+        self.process = process
+        self.full_policy = full_policy
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.workers = workers
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.inline = 0
+        self.errors = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run,
+                name='lizard-history-writer-%s' % i,
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, record):
+        """
+        Queue record, handling a full queue according to full_policy.
+        """
+        item = (time.time(), record)
+        self._count('submitted')
+        if self.full_policy == BLOCK:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            if self.full_policy == DROP:
+                self._count('dropped')
+                logger.warning(
+                    'History queue full, dropped a record of %s changes.',
+                    len(record.get('changes', [])),
+                )
+            else:
+                self._count('inline')
+                self.process([record])
+
+    def _take_batch(self):
+        """
+        Return a batch of items, blocking for the first one.
+
+        A batch ends at a stop marker, so that each worker takes one.
+        """
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            stop = _STOP in batch
+            items = [item for item in batch if item is not _STOP]
+            if items:
+                self._process_items(items)
+            for item in batch:
+                self.queue.task_done()
+            if stop:
+                break
+
+    def _process_items(self, items):
+        now = time.time()
+        lag = max(now - queued_at for queued_at, record in items)
+        with self._lock:
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+        try:
+            self.process([record for queued_at, record in items])
+        except Exception:
+            self._count('errors', len(items))
+            logger.exception('Failed to write %s history records.',
+                             len(items))
+            connection.close()  # Start the next batch afresh.
+        else:
+            self._count('written', len(items))
+
+    def flush(self):
+        """
+        Block until all queued records have been processed.
+        """
+        self.queue.join()
+
+    def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        """
+        Process the queued records and stop the worker threads.
+
+        Gives up after timeout seconds, also when the queue stays full.
+        """
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            try:
+                self.queue.put(_STOP, timeout=max(0, deadline - time.time()))
+            except Queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+        self.threads = [t for t in self.threads if t.is_alive()]
+        if self.threads:
+            logger.warning('History writer stopped with %s records queued.',
+                           self.queue.qsize())
+
+    def stats(self):
+        """
+        Return dict with counters, queue depth and lag in seconds.
+        """
+        with self._lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'submitted': self.submitted,
+                'written': self.written,
+                'dropped': self.dropped,
+                'inline': self.inline,
+                'errors': self.errors,
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag,
+            }
+
+
+_writer = []
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    Return the process wide writer, starting it on first use.
+    """
+    if not _writer:
+        from lizard_history.handlers import write_compact_records
+        with _writer_lock:
+            if not _writer:
+                writer = AsyncHistoryWriter(write_compact_records)
+                writer.start()
+                atexit.register(writer.stop)
+                _writer.append(writer)
+    return _writer[0]